@@ -0,0 +1,96 @@
+"""In-process pub/sub for pushing live updates to connected clients.
+
+Events are published per class and fanned out to that class's subscribers.
+Every subscriber has a bounded queue: a client that falls behind loses its
+backlog and receives a single "resync" event telling it to refetch, so one
+slow connection never holds more than `max_queue` events in memory.
+
+The bus is not shared between worker processes; clients connected to one
+worker only see events published by that worker.
+"""
+import asyncio
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, Iterable, Optional, Set
+
+RESYNC = "resync"
+
+
+@dataclass(frozen=True)
+class Event:
+    type: str
+    data: Any = None
+    # None delivers to every subscriber in the class
+    user_ids: Optional[FrozenSet[str]] = None
+
+
+class Subscription:
+    def __init__(self, bus: "EventBus", class_id: str, user_id: str, max_queue: int):
+        self.bus = bus
+        self.class_id = class_id
+        self.user_id = user_id
+        self.queue: "asyncio.Queue[Event]" = asyncio.Queue(maxsize=max_queue)
+        self.resyncs = 0
+
+    def deliver(self, event: Event) -> None:
+        if event.user_ids is not None and self.user_id not in event.user_ids:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Drop the backlog rather than grow; the client refetches on resync
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(Event(RESYNC))
+            self.resyncs += 1
+
+    async def next_event(self, timeout: float) -> Optional[Event]:
+        """Wait up to `timeout` seconds for the next event, returning None if none arrived"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self) -> None:
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    def __init__(self, max_queue: int = 100):
+        self.max_queue = max_queue
+        self.published = 0
+        self._subscribers: Dict[str, Set[Subscription]] = defaultdict(set)
+
+    def subscribe(self, class_id: str, user_id: str) -> Subscription:
+        subscription = Subscription(self, class_id, user_id, self.max_queue)
+        self._subscribers[class_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscribers = self._subscribers.get(subscription.class_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._subscribers[subscription.class_id]
+
+    def publish(self, class_id: Optional[str], event_type: str, data: Any = None,
+                user_ids: Optional[Iterable[str]] = None) -> None:
+        """Deliver an event to a class's subscribers, or only to `user_ids` among them"""
+        if not class_id or class_id not in self._subscribers:
+            return
+        event = Event(event_type, data, frozenset(user_ids) if user_ids is not None else None)
+        for subscription in list(self._subscribers[class_id]):
+            subscription.deliver(event)
+        self.published += 1
+
+    def stats(self) -> Dict[str, Any]:
+        subscriptions = [sub for subs in self._subscribers.values() for sub in subs]
+        return {
+            "classes": len(self._subscribers),
+            "subscribers": len(subscriptions),
+            "published": self.published,
+            "queued": sum(sub.queue.qsize() for sub in subscriptions),
+            "resyncs": sum(sub.resyncs for sub in subscriptions),
+            "max_queue": self.max_queue,
+        }
@@ -0,0 +1,188 @@
+"""Class data exports, streamed from a single joined Mongo cursor."""
+import asyncio
+import csv
+import io
+import zlib
+from datetime import date
+from typing import Any, AsyncIterator, BinaryIO, Dict, Iterator
+
+CSV_HEADER = ["student_name", "habit_name", "date", "completed"]
+CHUNK_SIZE = 64 * 1024
+# Longest export range; also keeps `date - timedelta(days=...)` well inside date's range
+MAX_RANGE_DAYS = 3660
+ARROW_BATCH_SIZE = 10000
+
+EXPORT_FORMATS = {
+    "csv": {"extension": "csv", "media_type": "text/csv"},
+    "parquet": {"extension": "parquet", "media_type": "application/vnd.apache.parquet"},
+    "feather": {"extension": "feather", "media_type": "application/vnd.apache.arrow.file"},
+}
+
+
+def export_rows(db, class_id: str, start_date: date, end_date: date):
+    """Cursor over one row per habit log in range, joined to its habit and student"""
+    return db.users.aggregate([
+        {"$match": {"class_id": class_id, "role": "student"}},
+        {"$project": {"_id": 0, "id": 1, "name": 1}},
+        {"$lookup": {
+            "from": "habits",
+            "localField": "id",
+            "foreignField": "user_id",
+            "as": "habit"
+        }},
+        {"$unwind": "$habit"},
+        {"$lookup": {
+            "from": "habit_logs",
+            "localField": "habit.id",
+            "foreignField": "habit_id",
+            "pipeline": [
+                {"$match": {"date": {"$gte": start_date.isoformat(), "$lte": end_date.isoformat()}}},
+                {"$sort": {"date": 1}},
+                {"$project": {"_id": 0, "date": 1, "completed": 1}}
+            ],
+            "as": "log"
+        }},
+        {"$unwind": "$log"},
+        {"$project": {
+            "student_id": "$id",
+            "student_name": "$name",
+            "habit_id": "$habit.id",
+            "habit_name": "$habit.title",
+            "date": "$log.date",
+            "completed": "$log.completed"
+        }}
+    ], allowDiskUse=True)
+
+
+async def csv_chunks(rows: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """Encode export rows as CSV, yielding roughly CHUNK_SIZE bytes at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADER)
+    async for row in rows:
+        writer.writerow([
+            row["student_name"],
+            row["habit_name"],
+            row["date"],
+            "Yes" if row["completed"] else "No"
+        ])
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows gzip: listed (or covered by `*`) with q > 0"""
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Gzip a byte stream incrementally"""
+    compressor = zlib.compressobj(wbits=31)  # 31 selects the gzip container
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _arrow_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("student_id", pa.string()),
+        ("student_name", pa.string()),
+        ("habit_id", pa.string()),
+        ("habit_name", pa.string()),
+        ("date", pa.date32()),
+        ("completed", pa.bool_()),
+    ])
+
+
+def _arrow_batch(schema, rows: list):
+    import pyarrow as pa
+
+    return pa.record_batch([
+        [row["student_id"] for row in rows],
+        [row["student_name"] for row in rows],
+        [row["habit_id"] for row in rows],
+        [row["habit_name"] for row in rows],
+        [date.fromisoformat(row["date"]) for row in rows],
+        [bool(row["completed"]) for row in rows],
+    ], schema=schema)
+
+
+async def write_arrow_export(rows: AsyncIterator[Dict[str, Any]], export_format: str, sink: BinaryIO):
+    """Write export rows to `sink` as a typed Parquet or Feather file.
+
+    Rows are converted to Arrow record batches of ARROW_BATCH_SIZE as the
+    cursor yields them, so only one batch is held in memory at a time.
+    """
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+
+    loop = asyncio.get_running_loop()
+    schema = _arrow_schema()
+
+    def open_writer():
+        if export_format == "parquet":
+            return pq.ParquetWriter(sink, schema)
+        # Feather v2 is the Arrow IPC file format
+        return ipc.new_file(sink, schema, options=ipc.IpcWriteOptions(compression="lz4"))
+
+    def write_batch(batch: list):
+        writer.write_batch(_arrow_batch(schema, batch))
+
+    # Encoding, compression and file I/O block, so they run off the event loop;
+    # each call is awaited before the next, keeping the writer single-threaded
+    writer = await loop.run_in_executor(None, open_writer)
+    try:
+        batch = []
+        async for row in rows:
+            batch.append(row)
+            if len(batch) >= ARROW_BATCH_SIZE:
+                await loop.run_in_executor(None, write_batch, batch)
+                batch = []
+        if batch:
+            await loop.run_in_executor(None, write_batch, batch)
+    finally:
+        await loop.run_in_executor(None, writer.close)
+
+
+def file_chunks(file: BinaryIO) -> Iterator[bytes]:
+    """Read a file from the start in CHUNK_SIZE pieces, closing it when done"""
+    try:
+        file.seek(0)
+        while chunk := file.read(CHUNK_SIZE):
+            yield chunk
+    finally:
+        file.close()
+
+
+async def write_export_file(rows: AsyncIterator[Dict[str, Any]], export_format: str, sink: BinaryIO):
+    """Write export rows to an open binary file in any EXPORT_FORMATS format"""
+    if export_format == "csv":
+        loop = asyncio.get_running_loop()
+        async for chunk in csv_chunks(rows):
+            await loop.run_in_executor(None, sink.write, chunk)
+    else:
+        await write_arrow_export(rows, export_format, sink)
@@ -0,0 +1,111 @@
+from datetime import date, timedelta
+from typing import List, Optional, Tuple
+
+
+class HabitBitmap:
+    """Day-indexed completion history for one habit.
+
+    Bit i of `completed` is set when the habit was completed on `start + i`
+    days; bit i of `logged` is set when that day has a log at all (completed
+    or not). Both are stored in habit_stats as little-endian bytes so streaks,
+    completion rates and the recent-days strip never need habit_logs reads.
+    """
+
+    def __init__(self, start: date, completed: int = 0, logged: int = 0):
+        self.start = start
+        self.completed = completed
+        self.logged = logged
+
+    @classmethod
+    def from_fields(cls, fields: dict) -> "HabitBitmap":
+        return cls(
+            date.fromisoformat(fields["bitmap_start"]),
+            int.from_bytes(fields["completed_bits"], "little"),
+            int.from_bytes(fields["logged_bits"], "little"),
+        )
+
+    @classmethod
+    def from_logs(cls, start: date, logs: List[dict]) -> "HabitBitmap":
+        bitmap = cls(start)
+        for log in logs:
+            bitmap.set(date.fromisoformat(log["date"]), log["completed"])
+        return bitmap
+
+    def to_fields(self) -> dict:
+        return {
+            "bitmap_start": self.start.isoformat(),
+            "completed_bits": _to_bytes(self.completed),
+            "logged_bits": _to_bytes(self.logged),
+        }
+
+    def _index(self, day: date) -> int:
+        return (day - self.start).days
+
+    def get(self, day: date) -> Optional[bool]:
+        """Completed value logged for a day, or None if it has no log"""
+        index = self._index(day)
+        if index < 0 or not (self.logged >> index) & 1:
+            return None
+        return bool((self.completed >> index) & 1)
+
+    def set(self, day: date, completed: bool) -> Optional[bool]:
+        """Record a day's log and return its previous value"""
+        previous = self.get(day)
+        index = self._index(day)
+        if index < 0:
+            # Logs before the current start move the origin back
+            self.completed <<= -index
+            self.logged <<= -index
+            self.start = day
+            index = 0
+
+        bit = 1 << index
+        self.logged |= bit
+        if completed:
+            self.completed |= bit
+        else:
+            self.completed &= ~bit
+        return previous
+
+    def current_streak(self, today: date) -> int:
+        """Consecutive completed days ending today"""
+        index = self._index(today)
+        if index < 0 or not (self.completed >> index) & 1:
+            return 0
+
+        mask = (1 << (index + 1)) - 1
+        gaps = ~self.completed & mask
+        if not gaps:
+            return index + 1
+        return index - (gaps.bit_length() - 1)
+
+    def best_streak(self) -> int:
+        """Longest run of consecutive completed days"""
+        # Each step clears the last bit of every run, so the number of steps
+        # until nothing is left is the length of the longest run
+        runs = self.completed
+        best = 0
+        while runs:
+            runs &= runs >> 1
+            best += 1
+        return best
+
+    def completed_count(self) -> int:
+        return self.completed.bit_count()
+
+    def total_count(self) -> int:
+        return self.logged.bit_count()
+
+    def recent(self, today: date, days: int = 7) -> List[Tuple[date, bool]]:
+        """Logged days in the window ending today, oldest first"""
+        result = []
+        for offset in range(days - 1, -1, -1):
+            day = today - timedelta(days=offset)
+            completed = self.get(day)
+            if completed is not None:
+                result.append((day, completed))
+        return result
+
+
+def _to_bytes(bits: int) -> bytes:
+    return bits.to_bytes((bits.bit_length() + 7) // 8, "little")
@@ -0,0 +1,364 @@
+"""Declarative MongoDB index set and query-plan report.
+
+`INDEXES` lists every index the routes rely on; `ensure_indexes` creates any
+that are missing, drops any in `RETIRED_INDEXES`, and is run on startup and
+from `manage.py`. `QUERY_SHAPES` mirrors the filters the routes issue and
+`PIPELINE_SHAPES` the joins of their aggregations, so `explain_report` can
+flag any that would fall back to a collection scan.
+"""
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+ASCENDING = 1
+DESCENDING = -1
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    collection: str
+    keys: Tuple[Tuple[str, int], ...]
+    unique: bool = False
+    # For unique indexes over derived or re-submittable data: if existing
+    # duplicates block the index, keep the document latest by these fields
+    dedupe_by: Optional[Tuple[str, ...]] = None
+
+    @property
+    def name(self) -> str:
+        return "_".join(f"{key}_{direction}" for key, direction in self.keys)
+
+
+@dataclass(frozen=True)
+class QueryShape:
+    name: str
+    collection: str
+    filter: Dict[str, Any]
+    sort: Optional[List[Tuple[str, int]]] = field(default=None)
+
+
+@dataclass(frozen=True)
+class PipelineShape:
+    name: str
+    collection: str
+    pipeline: List[Dict[str, Any]]
+
+
+def _keys(*fields: str) -> Tuple[Tuple[str, int], ...]:
+    return tuple((name, ASCENDING) for name in fields)
+
+
+INDEXES: List[IndexSpec] = [
+    IndexSpec("users", _keys("email"), unique=True),
+    IndexSpec("users", _keys("id"), unique=True),
+    IndexSpec("users", _keys("class_id", "role")),
+    IndexSpec("classes", _keys("id"), unique=True),
+    IndexSpec("classes", _keys("name")),
+    IndexSpec("habits", _keys("id"), unique=True),
+    IndexSpec("habits", _keys("user_id")),
+    IndexSpec("habit_logs", _keys("habit_id", "date"), unique=True, dedupe_by=("updated_at", "created_at")),
+    IndexSpec("habit_stats", _keys("habit_id"), unique=True, dedupe_by=("updated_at",)),
+    IndexSpec("user_stats", _keys("user_id"), unique=True),
+    IndexSpec("crews", _keys("id"), unique=True),
+    IndexSpec("crews", _keys("class_id", "created_at")),
+    IndexSpec("crews", _keys("members.user_id")),
+    IndexSpec("crew_members", _keys("user_id"), unique=True),
+    IndexSpec("crew_members", _keys("crew_id")),
+    IndexSpec("quests", _keys("id"), unique=True),
+    IndexSpec("quests", _keys("class_id", "start_date", "end_date")),
+    IndexSpec("quest_completions", _keys("quest_id", "user_id"), unique=True),
+    IndexSpec("xp_events", _keys("id"), unique=True),
+    IndexSpec("xp_events", _keys("user_id")),
+    IndexSpec("reward_items", _keys("user_id", "type", "label")),
+    IndexSpec("class_feeds", _keys("class_id"), unique=True),
+    IndexSpec("data_versions", _keys("key"), unique=True),
+    IndexSpec("export_jobs", _keys("id"), unique=True),
+    IndexSpec("export_jobs", _keys("requested_by", "class_id", "status")),
+    IndexSpec("migrations", _keys("name"), unique=True),
+    IndexSpec("nightly_runs", _keys("run_id"), unique=True),
+    IndexSpec("nightly_checkpoints", _keys("run_id", "class_id"), unique=True),
+]
+
+# Indexes no route uses any more; ensure_indexes drops them so writes stop paying for them
+RETIRED_INDEXES: List[IndexSpec] = [
+    # Last activity moved to habit_stats.last_logged_at
+    IndexSpec("habit_logs", (("habit_id", ASCENDING), ("created_at", DESCENDING))),
+]
+
+# Placeholder values only; plans depend on the shape of the filter, not its values
+QUERY_SHAPES: List[QueryShape] = [
+    QueryShape("login", "users", {"email": ""}),
+    QueryShape("current user", "users", {"id": ""}),
+    QueryShape("class members", "users", {"class_id": "", "role": "student"}),
+    QueryShape("register student", "classes", {"name": ""}),
+    QueryShape("teacher class", "classes", {"id": "", "teacher_id": ""}),
+    QueryShape("user habits", "habits", {"user_id": ""}),
+    QueryShape("owned habit", "habits", {"id": "", "user_id": ""}),
+    QueryShape("habit stats batch", "habit_stats", {"habit_id": {"$in": [""]}}),
+    QueryShape("habit log for date", "habit_logs", {"habit_id": "", "date": ""}),
+    QueryShape("habit log history", "habit_logs", {"habit_id": ""}),
+    QueryShape(
+        "export log range", "habit_logs", {"habit_id": "", "date": {"$gte": "", "$lte": ""}}
+    ),
+    QueryShape("user stats", "user_stats", {"user_id": ""}),
+    QueryShape("class crews", "crews", {"class_id": ""}),
+    QueryShape("crew", "crews", {"id": ""}),
+    QueryShape("member's crew", "crews", {"members.user_id": ""}),
+    QueryShape("crew membership", "crew_members", {"user_id": ""}),
+    QueryShape("member crews", "crew_members", {"user_id": {"$in": [""]}}),
+    QueryShape("crews batch", "crews", {"id": {"$in": [""]}}),
+    QueryShape(
+        "crew with room",
+        "crews",
+        {"class_id": "", "member_count": {"$lt": 4}, "members.user_id": {"$ne": ""}},
+        [("created_at", ASCENDING)],
+    ),
+    QueryShape("crew members", "crew_members", {"crew_id": ""}),
+    QueryShape(
+        "active quests",
+        "quests",
+        {"class_id": "", "start_date": {"$lte": ""}, "end_date": {"$gte": ""}},
+    ),
+    QueryShape("quest", "quests", {"id": ""}),
+    QueryShape("quest completion", "quest_completions", {"quest_id": "", "user_id": ""}),
+    QueryShape(
+        "quest completions batch", "quest_completions", {"quest_id": {"$in": [""]}, "user_id": ""}
+    ),
+    QueryShape("user xp events", "xp_events", {"user_id": ""}),
+    QueryShape("streak reward", "reward_items", {"user_id": "", "type": "crate", "label": ""}),
+    QueryShape("class feed", "class_feeds", {"class_id": ""}),
+    QueryShape("class feed member", "class_feeds", {"class_id": "", "rows.user_id": ""}),
+    QueryShape("data version", "data_versions", {"key": ""}),
+    QueryShape("export job", "export_jobs", {"id": "", "requested_by": ""}),
+    QueryShape(
+        "pending export job",
+        "export_jobs",
+        {"class_id": "", "requested_by": "", "status": {"$in": ["queued", "running"]}},
+    ),
+    QueryShape("migration", "migrations", {"name": "", "completed_at": {"$ne": None}}),
+    QueryShape("nightly checkpoints", "nightly_checkpoints", {"run_id": ""}),
+]
+
+
+
+def _lookup(source: str, local_field: str, foreign_field: str, **extra: Any) -> Dict[str, Any]:
+    return {"$lookup": {
+        "from": source, "localField": local_field, "foreignField": foreign_field, "as": source, **extra
+    }}
+
+
+# The $match and $lookup stages of each route aggregation (plus any stage that
+# renames a join key); projections that only reshape the output are left out
+PIPELINE_SHAPES: List[PipelineShape] = [
+    PipelineShape("class feed rows", "users", [
+        {"$match": {"class_id": ""}},
+        _lookup("habits", "id", "user_id"),
+        _lookup("habit_stats", "habits.id", "habit_id"),
+    ]),
+    PipelineShape("class analytics", "users", [
+        {"$match": {"class_id": "", "role": "student"}},
+        _lookup("habits", "id", "user_id"),
+        _lookup("habit_stats", "habits.id", "habit_id"),
+    ]),
+    PipelineShape("my crew", "crews", [
+        {"$match": {"members.user_id": ""}},
+        _lookup("users", "members.user_id", "id"),
+        _lookup("user_stats", "members.user_id", "user_id"),
+    ]),
+    PipelineShape("crew management", "classes", [
+        {"$match": {"id": ""}},
+        _lookup("crews", "id", "class_id"),
+        _lookup("users", "id", "class_id"),
+        _lookup("crew_members", "users.id", "user_id"),
+    ]),
+    PipelineShape("class export", "users", [
+        {"$match": {"class_id": "", "role": "student"}},
+        _lookup("habits", "id", "user_id"),
+        {"$unwind": "$habits"},
+        _lookup("habit_logs", "habits.id", "habit_id", pipeline=[
+            {"$match": {"date": {"$gte": "", "$lte": ""}}},
+            {"$sort": {"date": 1}},
+        ]),
+    ]),
+    PipelineShape("user best streak", "habits", [
+        {"$match": {"user_id": ""}},
+        _lookup("habit_stats", "id", "habit_id"),
+    ]),
+    PipelineShape("crew streaks", "crews", [
+        {"$match": {"id": {"$in": [""]}}},
+        _lookup("user_stats", "members.user_id", "user_id"),
+    ]),
+    PipelineShape("nightly habit stats", "users", [
+        {"$match": {"class_id": ""}},
+        _lookup("habits", "id", "user_id"),
+        {"$unwind": "$habits"},
+        {"$project": {"id": "$habits.id"}},
+        _lookup("habit_stats", "id", "habit_id"),
+    ]),
+    PipelineShape("nightly best streaks", "users", [
+        {"$match": {"class_id": ""}},
+        _lookup("habits", "id", "user_id"),
+        _lookup("habit_stats", "habits.id", "habit_id"),
+        _lookup("user_stats", "id", "user_id"),
+    ]),
+]
+
+
+async def remove_duplicates(db, spec: IndexSpec) -> int:
+    """Delete all but the latest document for each key of `spec` that has several"""
+    collection = db[spec.collection]
+    key_fields = [key for key, _ in spec.keys]
+    cursor = collection.aggregate([
+        {"$sort": {**{name: DESCENDING for name in spec.dedupe_by}, "_id": DESCENDING}},
+        {"$group": {
+            "_id": {name: f"${name}" for name in key_fields},
+            "keep": {"$first": "$_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    removed = 0
+    async for group in cursor:
+        result = await collection.delete_many({
+            **{name: group["_id"].get(name) for name in key_fields},
+            "_id": {"$ne": group["keep"]}
+        })
+        removed += result.deleted_count
+    return removed
+
+
+async def ensure_indexes(db) -> List[Dict[str, Any]]:
+    """Create any missing indexes, drop retired ones, and return a status row per index.
+
+    Duplicates blocking a unique index with `dedupe_by` are removed first.
+    Other failures (for example duplicate users) are logged and reported
+    rather than raised, so one bad collection doesn't stop the rest of the set
+    from being created.
+    """
+    results = []
+    for spec in INDEXES:
+        status = "ok"
+        try:
+            try:
+                await db[spec.collection].create_index(
+                    list(spec.keys), name=spec.name, unique=spec.unique
+                )
+            except OperationFailure as e:
+                if e.code != 11000 or not spec.dedupe_by:
+                    raise
+                removed = await remove_duplicates(db, spec)
+                logger.warning(f"Removed {removed} duplicate {spec.collection} documents to build {spec.name}")
+                await db[spec.collection].create_index(
+                    list(spec.keys), name=spec.name, unique=spec.unique
+                )
+                status = f"ok (removed {removed} duplicates)"
+        except OperationFailure as e:
+            status = f"failed: {e.details.get('errmsg', str(e)) if e.details else e}"
+            logger.error(f"Could not create index {spec.collection}.{spec.name}: {status}")
+        results.append({
+            "collection": spec.collection,
+            "index": spec.name,
+            "unique": spec.unique,
+            "status": status,
+        })
+    
+    for spec in RETIRED_INDEXES:
+        status = "absent"
+        try:
+            if spec.name in await db[spec.collection].index_information():
+                await db[spec.collection].drop_index(spec.name)
+                status = "dropped"
+        except OperationFailure as e:
+            status = f"failed: {e.details.get('errmsg', str(e)) if e.details else e}"
+            logger.error(f"Could not drop retired index {spec.collection}.{spec.name}: {status}")
+        results.append({
+            "collection": spec.collection,
+            "index": spec.name,
+            "unique": spec.unique,
+            "status": status,
+        })
+    return results
+
+
+def _plan_stages(plan: Any) -> List[Dict[str, Any]]:
+    """Flatten the stages of an explain() winning plan"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan)
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(_plan_stages(item))
+    return stages
+
+
+def _winning_plans(explain: Any) -> List[Any]:
+    """Every winningPlan in an explain result; aggregations nest them per stage"""
+    plans = []
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == "winningPlan":
+                plans.append(value)
+            else:
+                plans.extend(_winning_plans(value))
+    elif isinstance(explain, list):
+        for item in explain:
+            plans.extend(_winning_plans(item))
+    return plans
+
+
+def unindexed_lookups(pipeline: List[Dict[str, Any]]) -> List[str]:
+    """`collection.field` for each $lookup whose foreignField leads no index in INDEXES.
+
+    explain() at queryPlanner verbosity doesn't plan the foreign side of a
+    join, and without such an index every input document scans the whole
+    foreign collection.
+    """
+    leading_keys = {(spec.collection, spec.keys[0][0]) for spec in INDEXES}
+    missing = []
+    for stage in pipeline:
+        lookup = stage.get("$lookup")
+        if lookup and (lookup["from"], lookup["foreignField"]) not in leading_keys:
+            missing.append(f"{lookup['from']}.{lookup['foreignField']}")
+    return missing
+
+
+async def explain_report(db) -> List[Dict[str, Any]]:
+    """Run explain() for every route query shape and aggregation and flag collection scans"""
+    report = []
+    for shape in QUERY_SHAPES:
+        cursor = db[shape.collection].find(shape.filter)
+        if shape.sort:
+            cursor = cursor.sort(shape.sort)
+        explain = await cursor.explain()
+        stages = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        report.append({
+            "shape": shape.name,
+            "collection": shape.collection,
+            "stages": [stage["stage"] for stage in stages],
+            "indexes": sorted({stage["indexName"] for stage in stages if "indexName" in stage}),
+            "collscan": any(stage["stage"] == "COLLSCAN" for stage in stages),
+            "unindexed_lookups": [],
+        })
+    
+    for shape in PIPELINE_SHAPES:
+        explain = await db.command(
+            "explain",
+            {"aggregate": shape.collection, "pipeline": shape.pipeline, "cursor": {}},
+            verbosity="queryPlanner"
+        )
+        stages = _plan_stages(_winning_plans(explain))
+        report.append({
+            "shape": shape.name,
+            "collection": shape.collection,
+            "stages": [stage["stage"] for stage in stages],
+            "indexes": sorted({stage["indexName"] for stage in stages if "indexName" in stage}),
+            "collscan": any(stage["stage"] == "COLLSCAN" for stage in stages),
+            "unindexed_lookups": unindexed_lookups(shape.pipeline),
+        })
+    return report
@@ -0,0 +1,28 @@
+"""XP level curve: level L is reached at 10 * L^1.5 XP."""
+from bisect import bisect_right
+from typing import List
+
+TABULATED_LEVELS = 1000
+
+# LEVEL_THRESHOLDS[i] is the XP at which level i + 1 is counted, computed once
+# so a lookup is a binary search instead of a float power per level
+LEVEL_THRESHOLDS: List[float] = [10 * (level ** 1.5) for level in range(1, TABULATED_LEVELS + 1)]
+
+
+def calculate_level_from_xp(xp: int) -> int:
+    """Calculate level from XP using formula: threshold = 10 * level^1.5"""
+    if xp < LEVEL_THRESHOLDS[-1]:
+        return max(1, bisect_right(LEVEL_THRESHOLDS, xp))
+
+    # Past the table, invert the curve directly and correct for float rounding
+    level = int((xp / 10) ** (2 / 3))
+    while 10 * ((level + 1) ** 1.5) <= xp:
+        level += 1
+    while 10 * (level ** 1.5) > xp:
+        level -= 1
+    return level
+
+
+def get_xp_for_level(level: int) -> int:
+    """Get XP threshold for a given level"""
+    return int(10 * (level ** 1.5))
@@ -0,0 +1,52 @@
+"""Maintenance commands, run from the backend directory: `python manage.py --help`"""
+import asyncio
+
+import typer
+
+from indexes import ensure_indexes, explain_report
+from server import db, nightly_cron_job, replay_xp_ledger
+
+cli = typer.Typer(help="Strive backend maintenance commands")
+
+
+@cli.command("ensure-indexes")
+def ensure_indexes_command():
+    """Create any missing MongoDB indexes and drop retired ones"""
+    results = asyncio.run(ensure_indexes(db))
+    for row in results:
+        unique = " (unique)" if row["unique"] else ""
+        typer.echo(f"{row['collection']}.{row['index']}{unique}: {row['status']}")
+    if any(row["status"].startswith("failed") for row in results):
+        raise typer.Exit(code=1)
+
+
+@cli.command("explain-report")
+def explain_report_command():
+    """Explain every route query shape and aggregation and flag collection scans"""
+    report = asyncio.run(explain_report(db))
+    for row in report:
+        flag = "COLLSCAN" if row["collscan"] or row["unindexed_lookups"] else "ok"
+        indexes = ", ".join(row["indexes"]) or "-"
+        typer.echo(f"[{flag}] {row['shape']} ({row['collection']}): {' > '.join(row['stages'])} using {indexes}")
+        for lookup in row["unindexed_lookups"]:
+            typer.echo(f"    $lookup on unindexed {lookup}")
+    if any(row["collscan"] or row["unindexed_lookups"] for row in report):
+        raise typer.Exit(code=1)
+
+
+@cli.command("nightly")
+def nightly_command():
+    """Run today's nightly recompute, skipping classes already checkpointed"""
+    asyncio.run(nightly_cron_job())
+
+
+
+@cli.command("replay-xp")
+def replay_xp_command():
+    """Rebuild user XP and completion totals from the xp_events ledger"""
+    rebuilt = asyncio.run(replay_xp_ledger())
+    typer.echo(f"Rebuilt XP for {rebuilt} users")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,232 @@
+"""Per-route request latency and MongoDB command metrics in Prometheus text format.
+
+`MetricsMiddleware` opens a `RequestStats` for every HTTP request in a context
+variable. Motor runs pymongo in an executor with a copy of the caller's
+context, so `MongoCommandMetrics` can attribute each command to the request
+that issued it. When the response finishes, the request's commands are folded
+into the registry under the matched route template (e.g. `/api/habits/{habit_id}/log`).
+Commands issued outside a request, such as by the nightly job, are recorded
+under the route "background".
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COMMANDS_PER_REQUEST_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500)
+BACKGROUND_ROUTE = "background"
+UNMATCHED_ROUTE = "unmatched"
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestStats:
+    """Mongo commands issued while handling one request"""
+
+    def __init__(self):
+        self.commands: List[Tuple[str, str, float]] = []
+        self.failures: List[Tuple[str, str]] = []
+        self._lock = threading.Lock()
+
+    def add(self, command: str, collection: str, duration: float) -> None:
+        with self._lock:
+            self.commands.append((command, collection, duration))
+
+    def add_failure(self, command: str, collection: str) -> None:
+        with self._lock:
+            self.failures.append((command, collection))
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: Dict[Tuple[str, str, int], int] = defaultdict(int)
+        self.request_latency: Dict[Tuple[str, str], Histogram] = {}
+        self.commands_per_request: Dict[Tuple[str, str], Histogram] = {}
+        self.mongo_commands: Dict[Tuple[str, str, str], List[float]] = defaultdict(lambda: [0, 0.0])
+        self.mongo_failures: Dict[Tuple[str, str, str], int] = defaultdict(int)
+        self._collectors: List[Callable[[], List[str]]] = []
+
+    def record_command(self, route: str, command: str, collection: str, duration: float) -> None:
+        with self._lock:
+            totals = self.mongo_commands[(route, command, collection)]
+            totals[0] += 1
+            totals[1] += duration
+
+    def record_failure(self, route: str, command: str, collection: str) -> None:
+        with self._lock:
+            self.mongo_failures[(route, command, collection)] += 1
+
+    def record_request(self, method: str, route: str, status: int, duration: float, stats: RequestStats) -> None:
+        with self._lock:
+            self.requests[(method, route, status)] += 1
+            self.request_latency.setdefault((method, route), Histogram(LATENCY_BUCKETS)).observe(duration)
+            self.commands_per_request.setdefault(
+                (method, route), Histogram(COMMANDS_PER_REQUEST_BUCKETS)
+            ).observe(len(stats.commands))
+            for command, collection, command_duration in stats.commands:
+                totals = self.mongo_commands[(route, command, collection)]
+                totals[0] += 1
+                totals[1] += command_duration
+            for command, collection in stats.failures:
+                self.mongo_failures[(route, command, collection)] += 1
+
+    def add_collector(self, collector: Callable[[], List[str]]) -> None:
+        """Register a function returning extra exposition lines, e.g. cache counters"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            lines += [
+                "# HELP strive_http_requests_total HTTP requests by route and status.",
+                "# TYPE strive_http_requests_total counter",
+            ]
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append(f"strive_http_requests_total{_labels(method=method, route=route, status=status)} {count}")
+
+            lines += [
+                "# HELP strive_http_request_duration_seconds HTTP request latency by route.",
+                "# TYPE strive_http_request_duration_seconds histogram",
+            ]
+            for (method, route), histogram in sorted(self.request_latency.items()):
+                lines += _histogram_lines("strive_http_request_duration_seconds", histogram, method=method, route=route)
+
+            lines += [
+                "# HELP strive_mongo_commands_per_request MongoDB commands issued per HTTP request.",
+                "# TYPE strive_mongo_commands_per_request histogram",
+            ]
+            for (method, route), histogram in sorted(self.commands_per_request.items()):
+                lines += _histogram_lines("strive_mongo_commands_per_request", histogram, method=method, route=route)
+
+            lines += [
+                "# HELP strive_mongo_command_duration_seconds MongoDB command time by route, command and collection.",
+                "# TYPE strive_mongo_command_duration_seconds summary",
+            ]
+            for (route, command, collection), (count, total) in sorted(self.mongo_commands.items()):
+                labels = _labels(route=route, command=command, collection=collection)
+                lines.append(f"strive_mongo_command_duration_seconds_count{labels} {count}")
+                lines.append(f"strive_mongo_command_duration_seconds_sum{labels} {total:.6f}")
+
+            lines += [
+                "# HELP strive_mongo_command_failures_total Failed MongoDB commands by route, command and collection.",
+                "# TYPE strive_mongo_command_failures_total counter",
+            ]
+            for (route, command, collection), count in sorted(self.mongo_failures.items()):
+                lines.append(
+                    f"strive_mongo_command_failures_total{_labels(route=route, command=command, collection=collection)} {count}"
+                )
+
+        for collector in self._collectors:
+            lines += collector()
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**labels: Any) -> str:
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _histogram_lines(name: str, histogram: Histogram, **labels: Any) -> List[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {cumulative}")
+    lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {histogram.count}")
+    lines.append(f"{name}_sum{_labels(**labels)} {histogram.sum:.6f}")
+    lines.append(f"{name}_count{_labels(**labels)} {histogram.count}")
+    return lines
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """pymongo listener attributing every command to the request in the calling context"""
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+        self._pending: Dict[Tuple[int, Any], Tuple[Optional[RequestStats], str]] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        target = event.command.get(event.command_name)
+        collection = target if isinstance(target, str) else "-"
+        with self._lock:
+            self._pending[(event.request_id, event.connection_id)] = (current_request.get(), collection)
+
+    def _finish(self, event) -> Tuple[Optional[RequestStats], str]:
+        with self._lock:
+            return self._pending.pop((event.request_id, event.connection_id), (None, "-"))
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        stats, collection = self._finish(event)
+        duration = event.duration_micros / 1_000_000
+        if stats is not None:
+            stats.add(event.command_name, collection, duration)
+        else:
+            self.registry.record_command(BACKGROUND_ROUTE, event.command_name, collection, duration)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        stats, collection = self._finish(event)
+        if stats is not None:
+            stats.add_failure(event.command_name, collection)
+        else:
+            self.registry.record_failure(BACKGROUND_ROUTE, event.command_name, collection)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing each HTTP request and collecting its Mongo commands"""
+
+    def __init__(self, app, registry: MetricsRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_request.reset(token)
+            route = scope.get("route")
+            self.registry.record_request(
+                scope["method"],
+                getattr(route, "path", UNMATCHED_ROUTE),
+                status_code,
+                time.perf_counter() - started,
+                stats,
+            )
@@ -1,24 +1,37 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Response
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, status, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import uuid
 from datetime import datetime, date, timedelta
 import hashlib
+import json
 import jwt
 from passlib.context import CryptContext
 import asyncio
-import math
-import csv
-import io
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from cache import TTLCache
+from exports import (
+    EXPORT_FORMATS, MAX_RANGE_DAYS, accepts_gzip, csv_chunks, export_rows, file_chunks, gzip_chunks, write_arrow_export, write_export_file
+)
+from events import EventBus
+from habit_bitmap import HabitBitmap
+from metrics import MetricsMiddleware, MetricsRegistry, MongoCommandMetrics, current_request
+from indexes import ensure_indexes
+from levels import calculate_level_from_xp, get_xp_for_level
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')  # Loads backend-local env if present
@@ -26,14 +39,25 @@ load_dotenv(ROOT_DIR / '.env')  # Loads backend-local env if present
 # Environment
 ENV = os.getenv("ENV", "development").lower()
 
+# Per-route request and MongoDB command metrics, exposed at /internal/metrics
+metrics_registry = MetricsRegistry()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandMetrics(metrics_registry)])
 db = client[os.environ['DB_NAME']]
 
 # Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+# bcrypt releases the GIL, so hashing in a thread pool keeps the event loop free
+# and lets concurrent logins use several cores
+password_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("PASSWORD_HASH_WORKERS", "4")),
+    thread_name_prefix="password-hash"
+)
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 # In production, SECRET_KEY must be provided via env. In non-prod, provide a safe dev fallback.
 SECRET_KEY = os.getenv("SECRET_KEY") if ENV == "production" else os.getenv("SECRET_KEY", "dev-insecure-secret")
@@ -42,12 +66,39 @@ if ENV == "production" and not SECRET_KEY:
 
 ALGORITHM = "HS256"
 
+# Authenticated users are cached in-process so most requests skip the users lookup.
+# Anything that updates a users document must call user_cache.invalidate(user_id).
+user_cache = TTLCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+)
+USER_PROJECTION = {"_id": 0, "password_hash": 0}
+
+# Live updates pushed to /api/events streams; see events.py for the backpressure policy
+event_bus = EventBus(max_queue=int(os.getenv("EVENT_QUEUE_SIZE", "100")))
+EVENT_HEARTBEAT_SECONDS = float(os.getenv("EVENT_HEARTBEAT_SECONDS", "15"))
+# Browsers' EventSource can't send an Authorization header, so it connects with a
+# short-lived token scoped to the stream in the query string instead
+EVENT_STREAM_SCOPE = "events"
+EVENT_TOKEN_TTL_SECONDS = int(os.getenv("EVENT_TOKEN_TTL_SECONDS", "60"))
+
+# Each class's active quests, keyed by (class_id, date, quests data version) so the
+# set turns over when the day rolls over, and a quest created on any worker
+# bumps the version and so misses every worker's cached entry
+quest_cache = TTLCache(
+    maxsize=int(os.getenv("QUEST_CACHE_SIZE", "1000")),
+    ttl=float(os.getenv("QUEST_CACHE_TTL_SECONDS", "60"))
+)
+
 # Create the main app without a prefix
 app = FastAPI(title="One Thing - Habit Tracker")
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Operational endpoints live outside /api so they aren't routed through the public ingress
+internal_router = APIRouter(prefix="/internal")
+
 # Models
 class UserCreate(BaseModel):
     name: str
@@ -115,6 +166,7 @@ class StudentAnalytics(BaseModel):
     last_activity: Optional[datetime]
 
 class ClassMemberData(BaseModel):
+    user_id: str
     name: str
     role: str
     current_best_streak: int
@@ -194,114 +246,424 @@ class CrewAssignment(BaseModel):
 class CrewCreate(BaseModel):
     name: str
 
+class ExportJobCreate(BaseModel):
+    format: str = "csv"
+    range_days: int = Field(30, ge=1, le=MAX_RANGE_DAYS)
+
+class ExportJob(BaseModel):
+    id: str
+    class_id: str
+    format: str
+    range_days: int
+    start_date: date
+    end_date: date
+    status: str  # queued, running, done or failed
+    error: Optional[str] = None
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+
 # Helper functions
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+async def hash_password(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.hash, password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.verify, plain_password, hashed_password)
 
 def create_access_token(user_id: str) -> str:
     payload = {"user_id": user_id, "exp": datetime.utcnow() + timedelta(days=30)}
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
+def create_event_stream_token(user_id: str) -> str:
+    payload = {
+        "user_id": user_id,
+        "scope": EVENT_STREAM_SCOPE,
+        "exp": datetime.utcnow() + timedelta(seconds=EVENT_TOKEN_TTL_SECONDS)
+    }
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await get_user_from_token(credentials.credentials)
+
+async def get_user_from_token(token: str, scope: Optional[str] = None) -> User:
+    """Resolve a token to its user; scoped tokens are only accepted where that scope is expected"""
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = payload.get("user_id")
-        if not user_id:
+        if not user_id or payload.get("scope") != scope:
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        user_doc = await db.users.find_one({"id": user_id})
-        if not user_doc:
-            raise HTTPException(status_code=401, detail="User not found")
+        user = user_cache.get(user_id)
+        if user is None:
+            user_doc = await db.users.find_one({"id": user_id}, USER_PROJECTION)
+            if not user_doc:
+                raise HTTPException(status_code=401, detail="User not found")
+            user = User(**user_doc)
+            user_cache.set(user_id, user)
         
-        return User(**user_doc)
+        return user
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-async def calculate_streak(habit_id: str) -> tuple:
-    """Calculate current and best streak for a habit"""
-    logs = await db.habit_logs.find({"habit_id": habit_id}).sort("date", 1).to_list(1000)
+# Attempts at the bitmap_version compare-and-set before a log leaves its stats to the nightly rebuild
+HABIT_STATS_MAX_ATTEMPTS = 5
+# Loggable dates: a day ahead of the server allows for clients in later time
+# zones, and a year before the habit's start bounds how far its bitmap can grow
+HABIT_LOG_MAX_DAYS_AHEAD = 1
+HABIT_LOG_MAX_DAYS_BEFORE_START = 365
+
+def build_stats_doc(habit_id: str, bitmap: HabitBitmap, today: date) -> dict:
+    """Build a habit_stats document from a habit's completion bitmap"""
+    completed_count = bitmap.completed_count()
+    total_count = bitmap.total_count()
+    percent_complete = (completed_count / total_count * 100) if total_count > 0 else 0
     
-    if not logs:
-        return 0, 0
+    return {
+        "habit_id": habit_id,
+        "current_streak": bitmap.current_streak(today),
+        "best_streak": bitmap.best_streak(),
+        "percent_complete": percent_complete,
+        "completed_count": completed_count,
+        "total_count": total_count,
+        **bitmap.to_fields(),
+        "updated_at": datetime.utcnow()
+    }
+
+def recent_logs_from_bitmap(habit_id: str, bitmap: HabitBitmap, today: date) -> List[dict]:
+    """Build the 7-day status bar entries from a habit's completion bitmap"""
+    return [
+        {"habit_id": habit_id, "date": day.isoformat(), "completed": completed}
+        for day, completed in bitmap.recent(today)
+    ]
+
+async def rebuild_habit_bitmap(habit: dict) -> HabitBitmap:
+    """Rebuild a habit's completion bitmap from its full log history"""
+    logs = await db.habit_logs.find(
+        {"habit_id": habit["id"]},
+        {"_id": 0, "date": 1, "completed": 1}
+    ).to_list(None)
+    return HabitBitmap.from_logs(date.fromisoformat(habit["start_date"]), logs)
+
+async def load_habit_bitmap(habit: dict, stats_doc: Optional[dict]) -> HabitBitmap:
+    """Bitmap from stored stats, rebuilt from the logs for stats stored before bitmaps"""
+    if stats_doc and "completed_bits" in stats_doc:
+        return HabitBitmap.from_fields(stats_doc)
+    return await rebuild_habit_bitmap(habit)
+
+async def rebuild_habit_stats(habits: List[dict]) -> List[dict]:
+    """Rebuild and store bitmap stats for habits from their habit_logs, using one log query.
+
+    Clears the stale flag a gave-up live update leaves. A habit may carry the `bitmap_version` its stats were read at; its write is
+    skipped if a log changed the stats since, as that bitmap is already newer.
+    """
+    if not habits:
+        return []
+    
+    habit_ids = [habit["id"] for habit in habits]
+    logs = await db.habit_logs.find(
+        {"habit_id": {"$in": habit_ids}},
+        {"_id": 0, "habit_id": 1, "date": 1, "completed": 1, "created_at": 1, "updated_at": 1}
+    ).to_list(None)
+    
+    logs_by_habit: Dict[str, List[dict]] = {habit_id: [] for habit_id in habit_ids}
+    for log in logs:
+        logs_by_habit[log["habit_id"]].append(log)
     
-    # Calculate current streak (from today backwards)
-    current_streak = 0
     today = date.today()
-    check_date = today
-    
-    for i in range(30):  # Check last 30 days
-        log = next((l for l in logs if l["date"] == check_date.isoformat()), None)
-        if log and log["completed"]:
-            current_streak += 1
-            check_date -= timedelta(days=1)
-        else:
-            break
-    
-    # Calculate best streak
-    best_streak = 0
-    temp_streak = 0
+    stats_docs = []
+    operations = []
+    for habit in habits:
+        habit_logs = logs_by_habit[habit["id"]]
+        bitmap = HabitBitmap.from_logs(date.fromisoformat(habit["start_date"]), habit_logs)
+        stats_doc = build_stats_doc(habit["id"], bitmap, today)
+        stats_doc["last_logged_at"] = max((log_written_at(l) for l in habit_logs), default=None)
+        version = habit.get("bitmap_version")
+        stats_doc["bitmap_version"] = (version or 0) + 1
+        stats_docs.append(stats_doc)
+        operations.append(UpdateOne(
+            {"habit_id": habit["id"], "bitmap_version": version},
+            {"$set": dict(stats_doc), "$unset": {"stale": ""}},
+            upsert=version is None
+        ))
     
-    # Convert dates to date objects for comparison
-    for log in logs:
-        if log["completed"]:
-            temp_streak += 1
-            best_streak = max(best_streak, temp_streak)
-        else:
-            temp_streak = 0
+    try:
+        await db.habit_stats.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # A concurrent log created these stats first; its bitmap is newer than ours
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+    return stats_docs
+
+def log_written_at(log: dict) -> datetime:
+    """When a log was last ticked or unticked; logs from before updated_at only have created_at"""
+    return log.get("updated_at") or log["created_at"]
+
+async def record_habit_log_in_stats(habit: dict, day: date) -> Tuple[HabitBitmap, dict]:
+    """Record a day's stored log in the habit's bitmap, retrying if another log races it.
+
+    The write only applies if `bitmap_version` is unchanged since the stats were
+    read. The log is re-read after the stats, so whichever write wins carries the
+    latest value for the day even when on/off taps race.
+    """
+    for _ in range(HABIT_STATS_MAX_ATTEMPTS):
+        stats_doc = await db.habit_stats.find_one({"habit_id": habit["id"]}, {"_id": 0})
+        version = stats_doc.get("bitmap_version") if stats_doc else None
+        bitmap = await load_habit_bitmap(habit, stats_doc)
+        log = await db.habit_logs.find_one(
+            {"habit_id": habit["id"], "date": day.isoformat()},
+            {"_id": 0, "completed": 1, "created_at": 1, "updated_at": 1}
+        )
+        bitmap.set(day, log["completed"])
+        updated_stats = build_stats_doc(habit["id"], bitmap, date.today())
+        # Same definition the rebuild from habit_logs uses: the latest log write
+        previous_logged_at = stats_doc.get("last_logged_at") if stats_doc else None
+        updated_stats["last_logged_at"] = max(filter(None, [previous_logged_at, log_written_at(log)]))
+        updated_stats["bitmap_version"] = (version or 0) + 1
+        
+        try:
+            result = await db.habit_stats.update_one(
+                {"habit_id": habit["id"], "bitmap_version": version},
+                {"$set": updated_stats},
+                upsert=stats_doc is None
+            )
+        except DuplicateKeyError:
+            continue
+        if result.matched_count or result.upserted_id is not None:
+            return bitmap, updated_stats
     
-    return current_streak, best_streak
+    # Every attempt lost: flag the stats so the nightly job rebuilds them from habit_logs
+    logger.error(f"Could not update stats for habit {habit['id']} after {HABIT_STATS_MAX_ATTEMPTS} attempts")
+    await db.habit_stats.update_one({"habit_id": habit["id"]}, {"$set": {"stale": True}})
+    return bitmap, updated_stats
 
 # Gamification helper functions
-def calculate_level_from_xp(xp: int) -> int:
-    """Calculate level from XP using formula: threshold = 10 * level^1.5"""
-    level = 1
-    while xp >= 10 * (level ** 1.5):
-        level += 1
-    return level - 1 if level > 1 else 1
-
-def get_xp_for_level(level: int) -> int:
-    """Get XP threshold for a given level"""
-    return int(10 * (level ** 1.5))
-
-async def award_xp(user_id: str, xp_amount: int, habit_weight: int = 1):
-    """Award XP to user and update level if threshold is crossed"""
-    # Get or create user stats
-    user_stats = await db.user_stats.find_one({"user_id": user_id})
-    if not user_stats:
-        user_stats = {
-            "id": str(uuid.uuid4()),
-            "user_id": user_id,
-            "xp": 0,
-            "level": 1,
-            "best_streak": 0,
-            "total_completions": 0,
-            "created_at": datetime.utcnow()
-        }
-        await db.user_stats.insert_one(user_stats)
-    
-    # Calculate new XP and level
-    new_xp = user_stats["xp"] + (xp_amount * habit_weight)
-    new_level = calculate_level_from_xp(new_xp)
+async def award_xp(user_id: str, xp_amount: int, habit_weight: int = 1, reason: str = "habit_completion",
+                   source_id: Optional[str] = None):
+    """Record an XP award in the ledger and apply it atomically, returning the resulting XP and level"""
+    amount = xp_amount * habit_weight
+    # Two writes rather than one: the ledger event goes first, so a crash between
+    # them leaves an event that replay_xp_ledger applies rather than XP with no record
+    await db.xp_events.insert_one({
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "amount": amount,
+        "completions": 1,
+        "reason": reason,
+        "source_id": source_id,
+        "created_at": datetime.utcnow()
+    })
     
-    # Update user stats
-    await db.user_stats.update_one(
+    # $inc keeps concurrent awards from overwriting each other; the level is
+    # derived from xp on read, so nothing else needs to be written
+    previous = await db.user_stats.find_one_and_update(
         {"user_id": user_id},
         {
-            "$set": {
-                "xp": new_xp,
-                "level": new_level,
-                "total_completions": user_stats["total_completions"] + 1
-            }
-        }
+            "$inc": {"xp": amount, "total_completions": 1},
+            "$setOnInsert": {"id": str(uuid.uuid4()), "best_streak": 0, "created_at": datetime.utcnow()}
+        },
+        projection={"_id": 0, "xp": 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
     )
+    previous_xp = previous["xp"] if previous else 0
+    level = calculate_level_from_xp(previous_xp + amount)
+    return {
+        "xp_awarded": amount,
+        "xp": previous_xp + amount,
+        "level": level,
+        "leveled_up": level > calculate_level_from_xp(previous_xp)
+    }
+
+OPENING_BALANCE_MIGRATION = "xp_opening_balances"
+# A claim older than this is taken to belong to a process that died mid-migration
+MIGRATION_CLAIM_SECONDS = 300
+
+async def claim_migration(name: str) -> bool:
+    """Claim a one-time migration, returning False once it has completed.
+
+    While another process holds a live claim this waits for it to finish, so
+    no caller gets past an unfinished migration.
+    """
+    while True:
+        now = datetime.utcnow()
+        try:
+            await db.migrations.find_one_and_update(
+                {
+                    "name": name,
+                    "completed_at": None,
+                    "$or": [
+                        {"claimed_at": None},
+                        {"claimed_at": {"$lt": now - timedelta(seconds=MIGRATION_CLAIM_SECONDS)}}
+                    ]
+                },
+                {"$set": {"claimed_at": now}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            # Completed, or claimed by another process
+            migration = await db.migrations.find_one({"name": name})
+            if migration and migration.get("completed_at"):
+                return False
+            await asyncio.sleep(1)
+
+async def record_opening_xp_balances() -> int:
+    """Record XP earned before the ledger existed as one opening_balance event per user.
+
+    The balance is whatever a user's stored totals hold beyond their ledger
+    events. That is only exact while no awards are in flight, so this runs once
+    during startup, before the process serves requests, and every process
+    waits for it to complete. Event ids derive from the user id, so a run
+    resumed after a crash can't record a balance twice. Returns events recorded.
+    """
+    if not await claim_migration(OPENING_BALANCE_MIGRATION):
+        return 0
+    
+    recorded = 0
+    events = []
+    
+    async def flush_events():
+        nonlocal recorded
+        if not events:
+            return
+        try:
+            result = await db.xp_events.insert_many(events, ordered=False)
+            recorded += len(result.inserted_ids)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            recorded += e.details["nInserted"]
+        events.clear()
+    
+    cursor = db.user_stats.aggregate([
+        {"$match": {"$or": [{"xp": {"$gt": 0}}, {"total_completions": {"$gt": 0}}]}},
+        {"$lookup": {
+            "from": "xp_events",
+            "localField": "user_id",
+            "foreignField": "user_id",
+            "as": "events"
+        }},
+        {"$project": {
+            "_id": 0,
+            "user_id": 1,
+            "xp": {"$subtract": [{"$ifNull": ["$xp", 0]}, {"$sum": "$events.amount"}]},
+            "total_completions": {
+                "$subtract": [{"$ifNull": ["$total_completions", 0]}, {"$sum": "$events.completions"}]
+            }
+        }}
+    ], allowDiskUse=True, batchSize=NIGHTLY_BATCH_SIZE)
+    async for balance in cursor:
+        if not balance["xp"] and not balance["total_completions"]:
+            continue
+        events.append({
+            "id": f"opening_balance:{balance['user_id']}",
+            "user_id": balance["user_id"],
+            "amount": balance["xp"],
+            "completions": balance["total_completions"],
+            "reason": "opening_balance",
+            "source_id": None,
+            "created_at": datetime.utcnow()
+        })
+        if len(events) >= NIGHTLY_BATCH_SIZE:
+            await flush_events()
     
-    return new_level > user_stats["level"]  # Returns True if level increased
+    await flush_events()
+    await db.migrations.update_one(
+        {"name": OPENING_BALANCE_MIGRATION},
+        {"$set": {"completed_at": datetime.utcnow()}}
+    )
+    return recorded
+
+async def replay_xp_ledger() -> int:
+    """Rebuild every user's xp and total_completions from the xp_events ledger.
+
+    Opening balances are recorded first if startup hasn't done so yet, so
+    replaying never drops XP earned before the ledger. Returns the number of
+    users rebuilt.
+    """
+    await record_opening_xp_balances()
+    
+    rebuilt = 0
+    updates = []
+    cursor = db.xp_events.aggregate([
+        {"$group": {
+            "_id": "$user_id",
+            "xp": {"$sum": "$amount"},
+            "total_completions": {"$sum": "$completions"}
+        }}
+    ], allowDiskUse=True, batchSize=NIGHTLY_BATCH_SIZE)
+    async for totals in cursor:
+        updates.append(UpdateOne(
+            {"user_id": totals["_id"]},
+            {
+                "$set": {"xp": totals["xp"], "total_completions": totals["total_completions"]},
+                "$unset": {"level": ""},
+                "$setOnInsert": {"id": str(uuid.uuid4()), "best_streak": 0, "created_at": datetime.utcnow()}
+            },
+            upsert=True
+        ))
+        rebuilt += 1
+        if len(updates) >= NIGHTLY_BATCH_SIZE:
+            await flush_bulk(db.user_stats, updates)
+    
+    await flush_bulk(db.user_stats, updates)
+    await bump_data_versions(GLOBAL_VERSION_KEY)
+    return rebuilt
+
+# Crew membership lives on the crew document (members, member_count) so the
+# capacity check and the join are one conditional update. crew_members keeps
+# one claim per user, and its unique user_id index stops a user joining two crews.
+CREW_CAPACITY = 4
+
+async def add_crew_member(crew_filter: dict, user_id: str, joined_at: datetime) -> Optional[dict]:
+    """Add a user to the first matching crew with room, returning the crew or None if none has room"""
+    return await db.crews.find_one_and_update(
+        {**crew_filter, "member_count": {"$lt": CREW_CAPACITY}, "members.user_id": {"$ne": user_id}},
+        {"$push": {"members": {"user_id": user_id, "joined_at": joined_at}}, "$inc": {"member_count": 1}},
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def remove_crew_member(crew_id: str, user_id: str):
+    await db.crews.update_one(
+        {"id": crew_id, "members.user_id": user_id},
+        {"$pull": {"members": {"user_id": user_id}}, "$inc": {"member_count": -1}}
+    )
+
+async def claim_crew_membership(user_id: str, crew_id: str, joined_at: datetime):
+    """Record a user's crew; raises DuplicateKeyError if they're already in one"""
+    await db.crew_members.insert_one({
+        "id": str(uuid.uuid4()),
+        "crew_id": crew_id,
+        "user_id": user_id,
+        "joined_at": joined_at
+    })
+
+async def backfill_crew_members():
+    """Embed members and member_count on crews created before they were stored on the crew"""
+    crews = await db.crews.aggregate([
+        {"$match": {"member_count": {"$exists": False}}},
+        {"$project": {"_id": 0, "id": 1}},
+        {"$lookup": {
+            "from": "crew_members",
+            "localField": "id",
+            "foreignField": "crew_id",
+            "as": "members"
+        }}
+    ]).to_list(None)
+    await flush_bulk(db.crews, [
+        UpdateOne(
+            {"id": crew["id"], "member_count": {"$exists": False}},
+            {"$set": {
+                "members": [{"user_id": m["user_id"], "joined_at": m["joined_at"]} for m in crew["members"]],
+                "member_count": len(crew["members"])
+            }}
+        )
+        for crew in crews
+    ])
 
 async def auto_assign_to_crew(user_id: str, class_id: str):
     """Auto-assign student to crew of 4, create new crew if needed"""
@@ -310,70 +672,45 @@ async def auto_assign_to_crew(user_id: str, class_id: str):
     if existing_membership:
         return
     
-    # Find crews in the class with less than 4 members
-    crews = await db.crews.find({"class_id": class_id}).to_list(1000)
-    
-    target_crew = None
-    for crew in crews:
-        member_count = await db.crew_members.count_documents({"crew_id": crew["id"]})
-        if member_count < 4:
-            target_crew = crew
-            break
+    # Join the oldest crew in the class with room
+    joined_at = datetime.utcnow()
+    target_crew = await add_crew_member({"class_id": class_id}, user_id, joined_at)
     
     # Create new crew if none available
     if not target_crew:
-        crew_number = len(crews) + 1
+        crew_number = await db.crews.count_documents({"class_id": class_id}) + 1
         target_crew = {
             "id": str(uuid.uuid4()),
             "class_id": class_id,
             "name": f"Squad {crew_number}",
             "crew_streak": 0,
+            "members": [{"user_id": user_id, "joined_at": joined_at}],
+            "member_count": 1,
             "created_at": datetime.utcnow()
         }
         await db.crews.insert_one(target_crew)
     
-    # Add user to crew
-    crew_member = {
-        "id": str(uuid.uuid4()),
-        "crew_id": target_crew["id"],
-        "user_id": user_id,
-        "joined_at": datetime.utcnow()
-    }
-    await db.crew_members.insert_one(crew_member)
+    try:
+        await claim_crew_membership(user_id, target_crew["id"], joined_at)
+    except DuplicateKeyError:
+        # A concurrent request already placed this user in a crew
+        await remove_crew_member(target_crew["id"], user_id)
 
-async def calculate_crew_streak(crew_id: str) -> int:
-    """Calculate crew streak as MIN of all members' current streaks"""
-    crew_members = await db.crew_members.find({"crew_id": crew_id}).to_list(10)
-    if not crew_members:
-        return 0
-    
-    min_streak = float('inf')
-    
-    for member in crew_members:
-        # Get member's best current streak
-        user_habits = await db.habits.find({"user_id": member["user_id"]}).to_list(100)
-        member_best_streak = 0
-        
-        for habit in user_habits:
-            stats = await db.habit_stats.find_one({"habit_id": habit["id"]})
-            if stats:
-                member_best_streak = max(member_best_streak, stats["current_streak"])
-        
-        min_streak = min(min_streak, member_best_streak)
-    
-    return int(min_streak) if min_streak != float('inf') else 0
+STREAK_MILESTONES = [7, 14, 30]
 
-async def check_and_award_streak_rewards(user_id: str, new_streak: int):
-    """Check if user hit milestone streak and award rewards"""
-    milestones = [7, 14, 30]
-    
-    for milestone in milestones:
+def streak_crate_label(milestone: int) -> str:
+    return f"{milestone}-Day Streak Crate"
+
+async def check_and_award_streak_rewards(user_id: str, new_streak: int) -> List[dict]:
+    """Check if user hit milestone streak and award rewards, returning any newly awarded"""
+    awarded = []
+    for milestone in STREAK_MILESTONES:
         if new_streak == milestone:
             # Check if reward already exists
             existing_reward = await db.reward_items.find_one({
                 "user_id": user_id,
                 "type": "crate",
-                "label": f"{milestone}-Day Streak Crate"
+                "label": streak_crate_label(milestone)
             })
             
             if not existing_reward:
@@ -381,72 +718,485 @@ async def check_and_award_streak_rewards(user_id: str, new_streak: int):
                     "id": str(uuid.uuid4()),
                     "user_id": user_id,
                     "type": "crate",
-                    "label": f"{milestone}-Day Streak Crate",
+                    "label": streak_crate_label(milestone),
                     "awarded_at": datetime.utcnow()
                 }
                 await db.reward_items.insert_one(reward)
+                reward.pop("_id", None)
+                awarded.append(reward)
+    
+    return awarded
+
+def publish_user_progress(user: User, xp_result: Optional[dict], rewards: List[dict]):
+    """Push level-ups and newly awarded crates to the user's own event streams"""
+    if xp_result and xp_result["leveled_up"]:
+        event_bus.publish(user.class_id, "level_up", {"level": xp_result["level"], "xp": xp_result["xp"]},
+                          user_ids=[user.id])
+    for reward in rewards:
+        event_bus.publish(user.class_id, "reward", jsonable_encoder(reward), user_ids=[user.id])
+
+# Data versions, bumped on writes so derived artifacts and cached responses can
+# tell when they're stale. The global version is bumped by jobs that rewrite
+# many users' data at once, such as the nightly recompute.
+GLOBAL_VERSION_KEY = "global"
+
+def class_version_key(class_id: str) -> str:
+    return f"class:{class_id}"
+
+def quests_version_key(class_id: str) -> str:
+    """Bumped only by quest changes, unlike the class version every habit log bumps"""
+    return f"quests:{class_id}"
+
+def user_version_key(user_id: str) -> str:
+    return f"user:{user_id}"
+
+async def bump_data_versions(*keys: str):
+    await db.data_versions.bulk_write([
+        UpdateOne({"key": key}, {"$inc": {"version": 1}}, upsert=True) for key in keys
+    ], ordered=False)
+
+async def get_data_version(key: str) -> int:
+    doc = await db.data_versions.find_one({"key": key})
+    return doc["version"] if doc else 0
+
+async def get_data_versions(keys: List[str]) -> Dict[str, int]:
+    docs = await db.data_versions.find({"key": {"$in": keys}}, {"_id": 0}).to_list(len(keys))
+    versions = {doc["key"]: doc["version"] for doc in docs}
+    return {key: versions.get(key, 0) for key in keys}
+
+# Conditional GETs: read routes declare which data versions their response
+# depends on, and a matching If-None-Match is answered with 304 before the
+# route runs any of its own queries
+class NotModified(Exception):
+    def __init__(self, etag: str):
+        self.etag = etag
+
+@app.exception_handler(NotModified)
+async def not_modified_handler(request: Request, exc: NotModified):
+    return Response(status_code=304, headers={"ETag": exc.etag, "Cache-Control": "private, no-cache"})
+
+def versioned_response(*scopes: str):
+    """Dependency deriving the response ETag from the caller's "user", "class" and/or "quests" data versions"""
+    async def check_etag(request: Request, response: Response, current_user: User = Depends(get_current_user)):
+        keys = [GLOBAL_VERSION_KEY]
+        if "user" in scopes:
+            keys.append(user_version_key(current_user.id))
+        if "class" in scopes:
+            keys.append(class_version_key(current_user.class_id))
+        if "quests" in scopes:
+            keys.append(quests_version_key(current_user.class_id))
+        versions = await get_data_versions(keys)
+        # Routes can reuse these rather than read them again
+        request.state.data_versions = versions
+        
+        # Streaks and "active N days ago" depend on the date, so it is part of the tag
+        tag_source = "|".join(
+            [request.url.path, request.url.query, current_user.id, date.today().isoformat()]
+            + [f"{key}={version}" for key, version in versions.items()]
+        )
+        etag = f'W/"{hashlib.sha1(tag_source.encode()).hexdigest()[:24]}"'
+        
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag in [tag.strip() for tag in if_none_match.split(",")]:
+            raise NotModified(etag)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "private, no-cache"
+    
+    return check_etag
+
+# Materialized class feed
+def feed_rows_pipeline(match: dict) -> List[dict]:
+    """Aggregation producing class feed rows for the users matching `match`"""
+    return [
+        {"$match": match},
+        {"$project": {"_id": 0, "id": 1, "name": 1, "role": 1}},
+        {"$lookup": {
+            "from": "habits",
+            "localField": "id",
+            "foreignField": "user_id",
+            "as": "habits"
+        }},
+        {"$lookup": {
+            "from": "habit_stats",
+            "localField": "habits.id",
+            "foreignField": "habit_id",
+            "as": "stats"
+        }},
+        {"$project": {
+            "_id": 0,
+            "user_id": "$id",
+            "name": 1,
+            "role": 1,
+            "current_best_streak": {"$ifNull": [{"$max": "$stats.current_streak"}, 0]},
+            "total_habits": {"$size": "$habits"},
+            "total_completion_rate": {"$sum": "$stats.percent_complete"},
+            "last_active_at": {"$max": "$stats.last_logged_at"}
+        }}
+    ]
+
+async def compute_feed_rows(match: dict) -> List[dict]:
+    rows = await db.users.aggregate(feed_rows_pipeline(match)).to_list(None)
+    for row in rows:
+        total_completion_rate = row.pop("total_completion_rate")
+        average_completion_rate = total_completion_rate / row["total_habits"] if row["total_habits"] else 0
+        row["completion_rate"] = round(average_completion_rate, 1)
+        row.setdefault("last_active_at", None)
+    return rows
+
+async def rebuild_class_feed(class_id: str):
+    """Recompute every row of a class's materialized feed"""
+    rows = await compute_feed_rows({"class_id": class_id})
+    await db.class_feeds.update_one(
+        {"class_id": class_id},
+        {"$set": {"rows": rows, "updated_at": datetime.utcnow()}, "$inc": {"version": 1}},
+        upsert=True
+    )
+
+async def refresh_class_feed_member(user_id: str, class_id: str) -> Optional[dict]:
+    """Recompute one member's row of their class feed, rebuilding the feed if the row is missing"""
+    rows = await compute_feed_rows({"id": user_id})
+    if rows:
+        result = await db.class_feeds.update_one(
+            {"class_id": class_id, "rows.user_id": user_id},
+            {"$set": {"rows.$": rows[0], "updated_at": datetime.utcnow()}, "$inc": {"version": 1}}
+        )
+        if result.matched_count:
+            return rows[0]
+    await rebuild_class_feed(class_id)
+    return rows[0] if rows else None
+
+def feed_member_data(row: dict) -> ClassMemberData:
+    return ClassMemberData(
+        user_id=row["user_id"],
+        name=row["name"],
+        role=row["role"],
+        current_best_streak=row["current_best_streak"],
+        total_habits=row["total_habits"],
+        completion_rate=row["completion_rate"],
+        recent_activity=describe_recent_activity(row["last_active_at"])
+    )
+
+def describe_recent_activity(last_active_at: Optional[datetime]) -> str:
+    if not last_active_at:
+        return "No recent activity"
+    days_ago = (datetime.utcnow() - last_active_at).days
+    if days_ago == 0:
+        return "Active today"
+    elif days_ago == 1:
+        return "Active yesterday"
+    return f"Active {days_ago} days ago"
+
+async def award_streak_rewards_bulk(milestone_hits: set):
+    """Award streak crates for (user_id, streak) milestone hits in two round trips"""
+    if not milestone_hits:
+        return
+    
+    labels = {(user_id, streak_crate_label(streak)) for user_id, streak in milestone_hits}
+    existing = await db.reward_items.find(
+        {
+            "user_id": {"$in": list({user_id for user_id, _ in labels})},
+            "type": "crate",
+            "label": {"$in": list({label for _, label in labels})}
+        },
+        {"_id": 0, "user_id": 1, "label": 1}
+    ).to_list(None)
+    already_awarded = {(reward["user_id"], reward["label"]) for reward in existing}
+    
+    new_rewards = [
+        {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "type": "crate",
+            "label": label,
+            "awarded_at": datetime.utcnow()
+        }
+        for user_id, label in labels - already_awarded
+    ]
+    if new_rewards:
+        await db.reward_items.insert_many(new_rewards)
+
+# Stored best streaks; crew streaks are the MIN of their members' stored values
+async def refresh_user_best_streak(user_id: str) -> bool:
+    """Store a user's best current streak across their habits, returning whether it changed"""
+    result = await db.habits.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$project": {"_id": 0, "id": 1}},
+        {"$lookup": {
+            "from": "habit_stats",
+            "localField": "id",
+            "foreignField": "habit_id",
+            "as": "stats"
+        }},
+        {"$unwind": "$stats"},
+        {"$group": {"_id": None, "best_streak": {"$max": "$stats.current_streak"}}}
+    ]).to_list(1)
+    best_streak = result[0]["best_streak"] if result else 0
+    
+    previous = await db.user_stats.find_one_and_update(
+        {"user_id": user_id},
+        {"$set": {"best_streak": best_streak}},
+        projection={"_id": 0, "best_streak": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    return previous is None or previous.get("best_streak") != best_streak
+
+async def refresh_crew_streaks(crew_ids: List[str]):
+    """Set each crew's streak to the MIN of its members' stored best streaks"""
+    if not crew_ids:
+        return
+    
+    crews = await db.crews.aggregate([
+        {"$match": {"id": {"$in": crew_ids}}},
+        {"$project": {"_id": 0, "id": 1, "class_id": 1, "members": 1, "previous_streak": "$crew_streak"}},
+        {"$lookup": {
+            "from": "user_stats",
+            "localField": "members.user_id",
+            "foreignField": "user_id",
+            "as": "member_stats"
+        }},
+        {"$project": {
+            "id": 1,
+            "class_id": 1,
+            "member_ids": "$members.user_id",
+            "previous_streak": 1,
+            "crew_streak": {"$ifNull": [{"$min": "$member_stats.best_streak"}, 0]}
+        }}
+    ]).to_list(None)
+    await flush_bulk(db.crews, [
+        UpdateOne({"id": crew["id"]}, {"$set": {"crew_streak": crew["crew_streak"]}}) for crew in crews
+    ])
+    
+    for crew in crews:
+        if crew["crew_streak"] != crew.get("previous_streak"):
+            event_bus.publish(
+                crew["class_id"], "crew_streak",
+                {"crew_id": crew["id"], "crew_streak": crew["crew_streak"]},
+                user_ids=crew.get("member_ids", [])
+            )
+
+async def refresh_member_crew_streaks(user_ids: List[str]):
+    """Refresh the crew streaks of the crews these users belong to"""
+    crew_ids = await db.crew_members.distinct("crew_id", {"user_id": {"$in": user_ids}})
+    await refresh_crew_streaks(crew_ids)
 
 # Nightly cron job function
+NIGHTLY_BATCH_SIZE = int(os.getenv("NIGHTLY_BATCH_SIZE", "500"))
+NIGHTLY_CONCURRENCY = int(os.getenv("NIGHTLY_CONCURRENCY", "4"))
+
+async def flush_bulk(collection, operations: list):
+    """Send queued writes as one unordered bulk_write and clear the queue"""
+    if operations:
+        await collection.bulk_write(operations, ordered=False)
+        operations.clear()
+
+async def recompute_habit_stats_stage(class_id: str):
+    """Refresh the stats of a class's habits from their bitmaps and award streak milestones.
+
+    Only habits with no bitmap yet, or flagged stale by a live update that gave
+    up, are rebuilt from habit_logs; the rest never read their log history.
+    """
+    today = date.today()
+    updates = []
+    rebuilds = []
+    milestone_hits = set()
+    
+    def record_milestone(user_id: str, streak: int):
+        if streak in STREAK_MILESTONES:
+            milestone_hits.add((user_id, streak))
+    
+    async def rebuild_batch():
+        stats_docs = await rebuild_habit_stats(rebuilds)
+        for habit, stats_doc in zip(rebuilds, stats_docs):
+            record_milestone(habit["user_id"], stats_doc["current_streak"])
+        rebuilds.clear()
+    
+    cursor = db.users.aggregate([
+        {"$match": {"class_id": class_id}},
+        {"$project": {"_id": 0, "id": 1}},
+        {"$lookup": {
+            "from": "habits",
+            "localField": "id",
+            "foreignField": "user_id",
+            "as": "habit"
+        }},
+        {"$unwind": "$habit"},
+        {"$project": {"id": "$habit.id", "user_id": "$habit.user_id", "start_date": "$habit.start_date"}},
+        {"$lookup": {
+            "from": "habit_stats",
+            "localField": "id",
+            "foreignField": "habit_id",
+            "as": "stats"
+        }},
+        {"$project": {"id": 1, "user_id": 1, "start_date": 1, "stats": {"$first": "$stats"}}}
+    ], allowDiskUse=True, batchSize=NIGHTLY_BATCH_SIZE)
+    
+    async for habit in cursor:
+        stats_doc = habit.pop("stats", None)
+        if not stats_doc or "completed_bits" not in stats_doc or stats_doc.get("stale"):
+            # The version is read before the logs, so a log landing mid-rebuild wins
+            habit["bitmap_version"] = stats_doc.get("bitmap_version") if stats_doc else None
+            rebuilds.append(habit)
+            if len(rebuilds) >= NIGHTLY_BATCH_SIZE:
+                await rebuild_batch()
+            continue
+        
+        updated_stats = build_stats_doc(habit["id"], HabitBitmap.from_fields(stats_doc), today)
+        # Only the date-dependent figures change; the bitmap itself is written by log_habit,
+        # and a log since this read has already stored fresher figures
+        for field in ("bitmap_start", "completed_bits", "logged_bits"):
+            del updated_stats[field]
+        updates.append(UpdateOne(
+            {"habit_id": habit["id"], "bitmap_version": stats_doc.get("bitmap_version")},
+            {"$set": updated_stats}
+        ))
+        record_milestone(habit["user_id"], updated_stats["current_streak"])
+        if len(updates) >= NIGHTLY_BATCH_SIZE:
+            await flush_bulk(db.habit_stats, updates)
+    
+    await rebuild_batch()
+    await flush_bulk(db.habit_stats, updates)
+    await award_streak_rewards_bulk(milestone_hits)
+
+async def recompute_user_best_streaks_stage(class_id: str):
+    """Store each class member's best current streak and refresh the crews of those that changed"""
+    updates = []
+    changed_user_ids = []
+    cursor = db.users.aggregate([
+        {"$match": {"class_id": class_id}},
+        {"$project": {"_id": 0, "id": 1}},
+        {"$lookup": {
+            "from": "habits",
+            "localField": "id",
+            "foreignField": "user_id",
+            "as": "habits"
+        }},
+        {"$lookup": {
+            "from": "habit_stats",
+            "localField": "habits.id",
+            "foreignField": "habit_id",
+            "as": "stats"
+        }},
+        {"$lookup": {
+            "from": "user_stats",
+            "localField": "id",
+            "foreignField": "user_id",
+            "as": "user_stats"
+        }},
+        {"$project": {
+            "id": 1,
+            "best_streak": {"$ifNull": [{"$max": "$stats.current_streak"}, 0]},
+            "stored_best_streak": {"$first": "$user_stats.best_streak"}
+        }}
+    ], allowDiskUse=True, batchSize=NIGHTLY_BATCH_SIZE)
+    
+    async for user in cursor:
+        if user.get("stored_best_streak") == user["best_streak"]:
+            continue
+        
+        changed_user_ids.append(user["id"])
+        updates.append(UpdateOne(
+            {"user_id": user["id"]},
+            {
+                "$set": {"best_streak": user["best_streak"]},
+                "$setOnInsert": {
+                    "id": str(uuid.uuid4()),
+                    "xp": 0,
+                    "total_completions": 0,
+                    "created_at": datetime.utcnow()
+                }
+            },
+            upsert=True
+        ))
+        if len(updates) >= NIGHTLY_BATCH_SIZE:
+            await flush_bulk(db.user_stats, updates)
+    
+    await flush_bulk(db.user_stats, updates)
+    
+    # Only crews with a member whose streak moved can have a different MIN
+    for i in range(0, len(changed_user_ids), NIGHTLY_BATCH_SIZE):
+        await refresh_member_crew_streaks(changed_user_ids[i:i + NIGHTLY_BATCH_SIZE])
+
+async def recompute_class_shard(class_id: str):
+    """Run every nightly stage for one class; classes share no habits, users or crews"""
+    # 1. Recompute habit stats and award streak milestone rewards
+    await recompute_habit_stats_stage(class_id)
+    
+    # 2. Update user stats best streaks, and the crew streaks of members whose streak changed
+    await recompute_user_best_streaks_stage(class_id)
+    
+    # 3. Rebuild the class feed from the refreshed stats
+    await rebuild_class_feed(class_id)
+
 async def nightly_cron_job():
-    """Nightly cron job to recompute streaks, crew streaks, and award rewards"""
+    """Nightly cron job to recompute streaks, crew streaks, and award rewards.
+
+    Classes are processed as independent shards by NIGHTLY_CONCURRENCY workers.
+    Each finished shard is checkpointed under the day's run id, so re-running
+    after a crash only processes the classes that didn't finish.
+    """
+    run_id = date.today().isoformat()
     try:
-        logger.info("Starting nightly cron job...")
+        logger.info(f"Starting nightly cron job {run_id}...")
+        await db.nightly_runs.update_one(
+            {"run_id": run_id},
+            {"$set": {"completed_at": None}, "$setOnInsert": {"started_at": datetime.utcnow()}},
+            upsert=True
+        )
         
-        # 1. Recompute all habit stats
-        habits = await db.habits.find({}).to_list(10000)
-        for habit in habits:
-            current_streak, best_streak = await calculate_streak(habit["id"])
-            total_logs = await db.habit_logs.count_documents({"habit_id": habit["id"]})
-            completed_logs = await db.habit_logs.count_documents({"habit_id": habit["id"], "completed": True})
-            percent_complete = (completed_logs / total_logs * 100) if total_logs > 0 else 0
-            
-            await db.habit_stats.update_one(
-                {"habit_id": habit["id"]},
-                {
-                    "$set": {
-                        "current_streak": current_streak,
-                        "best_streak": best_streak,
-                        "percent_complete": percent_complete,
-                        "updated_at": datetime.utcnow()
-                    }
-                },
-                upsert=True
-            )
-            
-            # Check and award streak milestone rewards
-            await check_and_award_streak_rewards(habit["user_id"], current_streak)
+        shards = asyncio.Queue(maxsize=NIGHTLY_CONCURRENCY)
+        failed_shards = []
         
-        # 2. Update crew streaks
-        crews = await db.crews.find({}).to_list(1000)
-        for crew in crews:
-            crew_streak = await calculate_crew_streak(crew["id"])
-            await db.crews.update_one(
-                {"id": crew["id"]},
-                {"$set": {"crew_streak": crew_streak}}
-            )
+        async def shard_worker():
+            while True:
+                class_id = await shards.get()
+                if class_id is None:
+                    return
+                try:
+                    await recompute_class_shard(class_id)
+                    await db.nightly_checkpoints.insert_one({
+                        "run_id": run_id,
+                        "class_id": class_id,
+                        "completed_at": datetime.utcnow()
+                    })
+                except Exception as e:
+                    failed_shards.append(class_id)
+                    logger.error(f"Nightly shard for class {class_id} failed: {str(e)}")
         
-        # 3. Update user stats best streaks
-        users = await db.users.find({}).to_list(10000)
-        for user in users:
-            user_habits = await db.habits.find({"user_id": user["id"]}).to_list(100)
-            user_best_streak = 0
-            
-            for habit in user_habits:
-                stats = await db.habit_stats.find_one({"habit_id": habit["id"]})
-                if stats:
-                    user_best_streak = max(user_best_streak, stats["current_streak"])
-            
-            await db.user_stats.update_one(
-                {"user_id": user["id"]},
-                {"$set": {"best_streak": user_best_streak}},
-                upsert=True
-            )
+        # Classes already finished by an earlier attempt at this run, loaded once
+        checkpointed = set(await db.nightly_checkpoints.distinct("class_id", {"run_id": run_id}))
+        
+        workers = [asyncio.create_task(shard_worker()) for _ in range(NIGHTLY_CONCURRENCY)]
+        try:
+            async for class_doc in db.classes.find({}, {"_id": 0, "id": 1}):
+                if class_doc["id"] not in checkpointed:
+                    await shards.put(class_doc["id"])
+        finally:
+            for _ in workers:
+                await shards.put(None)
+            await asyncio.gather(*workers)
+        
+        await bump_data_versions(GLOBAL_VERSION_KEY)
+        
+        if failed_shards:
+            logger.error(f"Nightly cron job {run_id} left {len(failed_shards)} classes unfinished")
+            return
         
+        await db.nightly_runs.update_one({"run_id": run_id}, {"$set": {"completed_at": datetime.utcnow()}})
         logger.info("Nightly cron job completed successfully")
         
     except Exception as e:
         logger.error(f"Error in nightly cron job: {str(e)}")
 
+async def resume_interrupted_nightly_run():
+    """Finish today's nightly run if the process stopped part-way through it"""
+    run = await db.nightly_runs.find_one({"run_id": date.today().isoformat(), "completed_at": None})
+    if run:
+        logger.info(f"Resuming interrupted nightly cron job {run['run_id']}")
+        await nightly_cron_job()
+
+# Columnar exports spill from memory to a temporary file past this size
+EXPORT_SPOOL_MAX_MEMORY = int(os.getenv("EXPORT_SPOOL_MAX_MEMORY", str(16 * 1024 * 1024)))
+
 # Initialize scheduler
 scheduler = AsyncIOScheduler()
 scheduler.add_job(
@@ -488,7 +1238,7 @@ async def register(user_data: UserCreate):
         "id": user_id,
         "name": user_data.name,
         "email": user_data.email,
-        "password_hash": hash_password(user_data.password),
+        "password_hash": await hash_password(user_data.password),
         "role": user_data.role,
         "class_id": class_id,
         "created_at": datetime.utcnow()
@@ -508,12 +1258,13 @@ async def register(user_data: UserCreate):
         "id": str(uuid.uuid4()),
         "user_id": user_id,
         "xp": 0,
-        "level": 1,
         "best_streak": 0,
         "total_completions": 0,
         "created_at": datetime.utcnow()
     }
     await db.user_stats.insert_one(user_stats_doc)
+    await refresh_class_feed_member(user_id, class_id)
+    await bump_data_versions(class_version_key(class_id))
     
     token = create_access_token(user_id)
     return {"token": token, "user": User(**user_doc)}
@@ -521,62 +1272,48 @@ async def register(user_data: UserCreate):
 @api_router.post("/auth/login")
 async def login(login_data: UserLogin):
     user_doc = await db.users.find_one({"email": login_data.email})
-    if not user_doc or not verify_password(login_data.password, user_doc["password_hash"]):
+    if not user_doc or not await verify_password(login_data.password, user_doc["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     token = create_access_token(user_doc["id"])
     return {"token": token, "user": User(**user_doc)}
 
-@api_router.get("/habits")
-async def get_habits(current_user: User = Depends(get_current_user)):
+async def load_habits(current_user: User):
     habits = await db.habits.find({"user_id": current_user.id}).to_list(1000)
+    if not habits:
+        return []
+    
+    # Streaks, completion rates and the 7-day status bar all come from the
+    # stored completion bitmaps, so no habit_logs reads are needed
+    habit_ids = [h["id"] for h in habits]
+    stats_docs = await db.habit_stats.find({"habit_id": {"$in": habit_ids}}, {"_id": 0}).to_list(len(habit_ids))
+    stats_by_habit = {doc["habit_id"]: doc for doc in stats_docs if "completed_bits" in doc}
+    
+    # Habits whose stats predate bitmaps get them built in one batch
+    missing = [h for h in habits if h["id"] not in stats_by_habit]
+    for doc in await rebuild_habit_stats(missing):
+        stats_by_habit[doc["habit_id"]] = doc
     
-    # Get today's logs and stats for each habit
     today = date.today()
     result = []
-    
     for habit_doc in habits:
         habit = Habit(**habit_doc)
-        
-        # Get today's log
-        today_log = await db.habit_logs.find_one({
-            "habit_id": habit.id,
-            "date": today.isoformat()
-        })
-        
-        # Get last 7 days of logs for status bar
-        seven_days_ago = today - timedelta(days=6)
-        recent_logs = await db.habit_logs.find({
-            "habit_id": habit.id,
-            "date": {"$gte": seven_days_ago.isoformat(), "$lte": today.isoformat()}
-        }).to_list(7)
-        
-        # Get or calculate stats
-        stats_doc = await db.habit_stats.find_one({"habit_id": habit.id})
-        if not stats_doc:
-            current_streak, best_streak = await calculate_streak(habit.id)
-            total_logs = await db.habit_logs.count_documents({"habit_id": habit.id})
-            completed_logs = await db.habit_logs.count_documents({"habit_id": habit.id, "completed": True})
-            percent_complete = (completed_logs / total_logs * 100) if total_logs > 0 else 0
-            
-            stats_doc = {
-                "habit_id": habit.id,
-                "current_streak": current_streak,
-                "best_streak": best_streak,
-                "percent_complete": percent_complete,
-                "updated_at": datetime.utcnow()
-            }
-            await db.habit_stats.insert_one(stats_doc)
+        stats_doc = stats_by_habit[habit.id]
+        bitmap = HabitBitmap.from_fields(stats_doc)
         
         result.append({
             "habit": habit.dict(),
-            "today_completed": today_log["completed"] if today_log else False,
-            "recent_logs": recent_logs,
-            "stats": HabitStats(**stats_doc).dict()
+            "today_completed": bitmap.get(today) or False,
+            "recent_logs": recent_logs_from_bitmap(habit.id, bitmap, today),
+            "stats": HabitStats(**build_stats_doc(habit.id, bitmap, today)).dict()
         })
     
     return result
 
+@api_router.get("/habits", dependencies=[Depends(versioned_response("user"))])
+async def get_habits(current_user: User = Depends(get_current_user)):
+    return await load_habits(current_user)
+
 @api_router.post("/habits", status_code=201)
 async def create_habit(habit_data: HabitCreate, current_user: User = Depends(get_current_user)):
     # Map frontend fields to backend fields
@@ -602,14 +1339,10 @@ async def create_habit(habit_data: HabitCreate, current_user: User = Depends(get
     await db.habits.insert_one(habit_doc)
     
     # Create initial habit stats
-    stats_doc = {
-        "habit_id": habit_doc["id"],
-        "current_streak": 0,
-        "best_streak": 0,
-        "percent_complete": 0.0,
-        "updated_at": datetime.utcnow()
-    }
+    stats_doc = build_stats_doc(habit_doc["id"], HabitBitmap(start_date), date.today())
     await db.habit_stats.insert_one(stats_doc)
+    await refresh_class_feed_member(current_user.id, current_user.class_id)
+    await bump_data_versions(user_version_key(current_user.id), class_version_key(current_user.class_id))
     
     # Return the habit with recent_logs array for consistency
     created_habit = Habit(**{k: v for k, v in habit_doc.items() if k != "custom_data"})  # Exclude custom_data from Habit model
@@ -626,63 +1359,81 @@ async def create_habit(habit_data: HabitCreate, current_user: User = Depends(get
     }
 
 @api_router.post("/habits/{habit_id}/log")
-async def log_habit(habit_id: str, log_data: HabitLogCreate, current_user: User = Depends(get_current_user)):
+async def log_habit(habit_id: str, log_data: HabitLogCreate, delta: bool = False,
+                    current_user: User = Depends(get_current_user)):
+    """Log a habit for a date. With `delta=true` the response also carries everything the
+    toggle changed (habit stats, 7-day strip, XP, rewards, feed row) so clients needn't refetch."""
     # Verify habit belongs to user
     habit = await db.habits.find_one({"id": habit_id, "user_id": current_user.id})
     if not habit:
         raise HTTPException(status_code=404, detail="Habit not found")
     
-    # Check if log already exists for this date
-    existing_log = await db.habit_logs.find_one({
-        "habit_id": habit_id,
-        "date": log_data.date.isoformat()
-    })
-    
-    if existing_log:
-        # Update existing log
-        await db.habit_logs.update_one(
-            {"id": existing_log["id"]},
-            {"$set": {"completed": log_data.completed}}
+    if log_data.date > date.today() + timedelta(days=HABIT_LOG_MAX_DAYS_AHEAD):
+        raise HTTPException(status_code=400, detail="Cannot log a habit for a future date")
+    earliest = date.fromisoformat(habit["start_date"]) - timedelta(days=HABIT_LOG_MAX_DAYS_BEFORE_START)
+    if log_data.date < earliest:
+        raise HTTPException(status_code=400, detail=f"Cannot log a habit before {earliest.isoformat()}")
+    
+    # Upsert the log in one round trip; the unique (habit_id, date) index
+    # keeps double-submitted taps from creating duplicate logs
+    log_filter = {"habit_id": habit_id, "date": log_data.date.isoformat()}
+    log_update = {
+        "$set": {"completed": log_data.completed, "updated_at": datetime.utcnow()},
+        "$setOnInsert": {"id": str(uuid.uuid4()), "created_at": datetime.utcnow()}
+    }
+    try:
+        log_doc = await db.habit_logs.find_one_and_update(
+            log_filter, log_update, upsert=True, return_document=ReturnDocument.AFTER
         )
-        log_doc = await db.habit_logs.find_one({"id": existing_log["id"]})
-    else:
-        # Create new log
-        log_doc = {
-            "id": str(uuid.uuid4()),
-            "habit_id": habit_id,
-            "date": log_data.date.isoformat(),
-            "completed": log_data.completed,
-            "created_at": datetime.utcnow()
-        }
-        await db.habit_logs.insert_one(log_doc)
-    
-    # Update stats
-    current_streak, best_streak = await calculate_streak(habit_id)
-    total_logs = await db.habit_logs.count_documents({"habit_id": habit_id})
-    completed_logs = await db.habit_logs.count_documents({"habit_id": habit_id, "completed": True})
-    percent_complete = (completed_logs / total_logs * 100) if total_logs > 0 else 0
-    
-    await db.habit_stats.update_one(
-        {"habit_id": habit_id},
-        {"$set": {
-            "current_streak": current_streak,
-            "best_streak": best_streak,
-            "percent_complete": percent_complete,
-            "updated_at": datetime.utcnow()
-        }},
-        upsert=True
-    )
+    except DuplicateKeyError:
+        # A concurrent tap inserted the log first; apply ours as an update
+        log_doc = await db.habit_logs.find_one_and_update(
+            log_filter, log_update, return_document=ReturnDocument.AFTER
+        )
+    
+    # Update stats by recording the toggled date in the habit's bitmap
+    bitmap, updated_stats = await record_habit_log_in_stats(habit, log_data.date)
+    current_streak = updated_stats["current_streak"]
+    
+    feed_row = await refresh_class_feed_member(current_user.id, current_user.class_id)
+    
+    # Keep the stored best streak, and the crew streak derived from it, live
+    if await refresh_user_best_streak(current_user.id):
+        await refresh_member_crew_streaks([current_user.id])
     
     # Award XP if habit was marked complete (not uncompleted)
+    xp_result = None
+    rewards = []
     if log_data.completed:
         habit_weight = 1  # Default weight, could be expanded later
-        await award_xp(current_user.id, 1, habit_weight)
-        await check_and_award_streak_rewards(current_user.id, current_streak)
+        xp_result = await award_xp(current_user.id, 1, habit_weight, source_id=log_doc["id"])
+        rewards = await check_and_award_streak_rewards(current_user.id, current_streak)
+    
+    # Bump only after the last write, so no ETag for the new versions is ever
+    # attached to a response read before the writes landed
+    await bump_data_versions(user_version_key(current_user.id), class_version_key(current_user.class_id))
+    
+    if feed_row:
+        event_bus.publish(current_user.class_id, "feed_row", jsonable_encoder(feed_member_data(feed_row)))
+    publish_user_progress(current_user, xp_result, rewards)
     
-    return HabitLog(**log_doc)
+    if not delta:
+        return HabitLog(**log_doc)
+    
+    today = date.today()
+    return {
+        "log": HabitLog(**log_doc),
+        "habit_id": habit_id,
+        "today_completed": bitmap.get(today) or False,
+        "recent_logs": recent_logs_from_bitmap(habit_id, bitmap, today),
+        "stats": HabitStats(**updated_stats),
+        "xp": xp_result,
+        "user_stats": await load_my_stats(current_user),
+        "rewards": rewards,
+        "feed_row": feed_member_data(feed_row) if feed_row else None
+    }
 
-@api_router.get("/classes/{class_id}/analytics")
-async def get_class_analytics(class_id: str, current_user: User = Depends(get_current_user)):
+async def load_class_analytics(class_id: str, current_user: User):
     # Verify user is teacher and owns this class
     if current_user.role != "teacher":
         raise HTTPException(status_code=403, detail="Only teachers can access class analytics")
@@ -691,48 +1442,50 @@ async def get_class_analytics(class_id: str, current_user: User = Depends(get_cu
     if not class_doc:
         raise HTTPException(status_code=404, detail="Class not found or access denied")
     
-    # Get all students in this class
-    students = await db.users.find({"class_id": class_id, "role": "student"}).to_list(1000)
+    # Join every student to their habits and stored habit stats in one aggregation
+    students = await db.users.aggregate([
+        {"$match": {"class_id": class_id, "role": "student"}},
+        {"$project": {"_id": 0, "id": 1, "name": 1, "email": 1}},
+        {"$lookup": {
+            "from": "habits",
+            "localField": "id",
+            "foreignField": "user_id",
+            "as": "habits"
+        }},
+        {"$lookup": {
+            "from": "habit_stats",
+            "localField": "habits.id",
+            "foreignField": "habit_id",
+            "as": "stats"
+        }},
+        {"$project": {
+            "name": 1,
+            "email": 1,
+            "total_habits": {"$size": "$habits"},
+            "active_habits": {"$size": {"$filter": {
+                "input": "$stats",
+                "as": "s",
+                "cond": {"$gt": ["$$s.current_streak", 0]}
+            }}},
+            "best_current_streak": {"$ifNull": [{"$max": "$stats.current_streak"}, 0]},
+            "total_completion_rate": {"$sum": "$stats.percent_complete"},
+            "last_activity": {"$max": "$stats.last_logged_at"}
+        }}
+    ]).to_list(None)
     
     analytics = []
     for student in students:
-        # Get student's habits
-        habits = await db.habits.find({"user_id": student["id"]}).to_list(1000)
-        
-        # Calculate analytics
-        total_habits = len(habits)
-        active_habits = 0
-        best_current_streak = 0
-        total_completion_rate = 0
-        last_activity = None
-        
-        for habit in habits:
-            # Get stats
-            stats = await db.habit_stats.find_one({"habit_id": habit["id"]})
-            if stats:
-                if stats["current_streak"] > 0:
-                    active_habits += 1
-                best_current_streak = max(best_current_streak, stats["current_streak"])
-                total_completion_rate += stats["percent_complete"]
-        
-        # Get last activity
-        last_log = await db.habit_logs.find_one(
-            {"habit_id": {"$in": [h["id"] for h in habits]}},
-            sort=[("created_at", -1)]
-        )
-        if last_log:
-            last_activity = last_log["created_at"]
-        
-        average_completion_rate = total_completion_rate / total_habits if total_habits > 0 else 0
+        total_habits = student["total_habits"]
+        average_completion_rate = student["total_completion_rate"] / total_habits if total_habits > 0 else 0
         
         analytics.append(StudentAnalytics(
             student_name=student["name"],
             student_email=student["email"],
             total_habits=total_habits,
-            active_habits=active_habits,
-            best_current_streak=best_current_streak,
+            active_habits=student["active_habits"],
+            best_current_streak=student["best_current_streak"],
             average_completion_rate=round(average_completion_rate, 1),
-            last_activity=last_activity
+            last_activity=student.get("last_activity")
         ))
     
     return {
@@ -741,63 +1494,29 @@ async def get_class_analytics(class_id: str, current_user: User = Depends(get_cu
         "analytics": analytics
     }
 
-@api_router.get("/my-class/feed")
-async def get_class_feed(current_user: User = Depends(get_current_user)):
-    # Get all users in the same class
-    class_members = await db.users.find({"class_id": current_user.class_id}).to_list(1000)
+@api_router.get("/classes/{class_id}/analytics")
+async def get_class_analytics(class_id: str, current_user: User = Depends(get_current_user)):
+    return await load_class_analytics(class_id, current_user)
+
+async def load_class_feed(current_user: User):
+    # Served from the class's materialized feed, refreshed as members log habits
+    feed = await db.class_feeds.find_one({"class_id": current_user.class_id}, {"_id": 0})
+    if not feed:
+        await rebuild_class_feed(current_user.class_id)
+        feed = await db.class_feeds.find_one({"class_id": current_user.class_id}, {"_id": 0})
     
-    feed_data = []
-    for member in class_members:
-        # Get member's habits
-        habits = await db.habits.find({"user_id": member["id"]}).to_list(1000)
-        
-        # Calculate member's best current streak and completion rate
-        best_current_streak = 0
-        total_completion_rate = 0
-        active_habits = 0
-        
-        for habit in habits:
-            stats = await db.habit_stats.find_one({"habit_id": habit["id"]})
-            if stats:
-                best_current_streak = max(best_current_streak, stats["current_streak"])
-                total_completion_rate += stats["percent_complete"]
-                if stats["current_streak"] > 0:
-                    active_habits += 1
-        
-        average_completion_rate = total_completion_rate / len(habits) if habits else 0
-        
-        # Get recent activity
-        recent_activity = "No recent activity"
-        if habits:
-            recent_log = await db.habit_logs.find_one(
-                {"habit_id": {"$in": [h["id"] for h in habits]}},
-                sort=[("created_at", -1)]
-            )
-            if recent_log:
-                days_ago = (datetime.utcnow() - recent_log["created_at"]).days
-                if days_ago == 0:
-                    recent_activity = "Active today"
-                elif days_ago == 1:
-                    recent_activity = "Active yesterday"
-                else:
-                    recent_activity = f"Active {days_ago} days ago"
-        
-        feed_data.append(ClassMemberData(
-            name=member["name"],
-            role=member["role"],
-            current_best_streak=best_current_streak,
-            total_habits=len(habits),
-            completion_rate=round(average_completion_rate, 1),
-            recent_activity=recent_activity
-        ))
+    feed_data = [feed_member_data(row) for row in feed["rows"]]
     
     # Sort by current best streak descending
     feed_data.sort(key=lambda x: x.current_best_streak, reverse=True)
     
     return feed_data
 
-@api_router.get("/my-class/info")
-async def get_class_info(current_user: User = Depends(get_current_user)):
+@api_router.get("/my-class/feed", dependencies=[Depends(versioned_response("class"))])
+async def get_class_feed(current_user: User = Depends(get_current_user)):
+    return await load_class_feed(current_user)
+
+async def load_class_info(current_user: User):
     class_doc = await db.classes.find_one({"id": current_user.class_id})
     if not class_doc:
         raise HTTPException(status_code=404, detail="Class not found")
@@ -816,129 +1535,190 @@ async def get_class_info(current_user: User = Depends(get_current_user)):
         "your_role": current_user.role
     }
 
+@api_router.get("/my-class/info", dependencies=[Depends(versioned_response("class"))])
+async def get_class_info(current_user: User = Depends(get_current_user)):
+    return await load_class_info(current_user)
+
 # Gamification API Endpoints
 @api_router.post("/crews/join")
 async def join_crew(crew_request: CrewJoinRequest, current_user: User = Depends(get_current_user)):
-    # Check if user is already in a crew
-    existing_membership = await db.crew_members.find_one({"user_id": current_user.id})
-    if existing_membership:
+    # Claim the user's single crew membership
+    joined_at = datetime.utcnow()
+    try:
+        await claim_crew_membership(current_user.id, crew_request.crew_id, joined_at)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Already in a crew")
     
-    # Verify crew exists and has space
-    crew = await db.crews.find_one({"id": crew_request.crew_id})
+    # Join only if the crew is in the user's class and has space, in one conditional update
+    crew = await add_crew_member(
+        {"id": crew_request.crew_id, "class_id": current_user.class_id}, current_user.id, joined_at
+    )
     if not crew:
-        raise HTTPException(status_code=404, detail="Crew not found")
-
-    # Enforce class scoping: user must be in same class as crew
-    if crew.get("class_id") != current_user.class_id:
-        raise HTTPException(status_code=403, detail="You can only join crews from your class")
-    
-    member_count = await db.crew_members.count_documents({"crew_id": crew_request.crew_id})
-    if member_count >= 4:
+        await db.crew_members.delete_one({"user_id": current_user.id, "crew_id": crew_request.crew_id})
+        
+        existing_crew = await db.crews.find_one({"id": crew_request.crew_id}, {"_id": 0, "class_id": 1})
+        if not existing_crew:
+            raise HTTPException(status_code=404, detail="Crew not found")
+        
+        # Enforce class scoping: user must be in same class as crew
+        if existing_crew.get("class_id") != current_user.class_id:
+            raise HTTPException(status_code=403, detail="You can only join crews from your class")
+        
         raise HTTPException(status_code=400, detail="Crew is full")
     
-    # Add user to crew
-    crew_member = {
-        "id": str(uuid.uuid4()),
-        "crew_id": crew_request.crew_id,
-        "user_id": current_user.id,
-        "joined_at": datetime.utcnow()
-    }
-    await db.crew_members.insert_one(crew_member)
+    await refresh_crew_streaks([crew["id"]])
+    await bump_data_versions(class_version_key(current_user.class_id))
     
     return {"message": "Successfully joined crew", "crew_name": crew["name"]}
 
-@api_router.get("/crews/me")
-async def get_my_crew(current_user: User = Depends(get_current_user)):
-    # Find user's crew membership
-    membership = await db.crew_members.find_one({"user_id": current_user.id})
-    if not membership:
+async def load_my_crew(current_user: User):
+    # Load the user's crew with each member's name and stored best streak in one aggregation
+    crews = await db.crews.aggregate([
+        {"$match": {"members.user_id": current_user.id}},
+        {"$project": {"_id": 0, "name": 1, "crew_streak": 1, "members": 1}},
+        {"$lookup": {
+            "from": "users",
+            "localField": "members.user_id",
+            "foreignField": "id",
+            "as": "users"
+        }},
+        {"$lookup": {
+            "from": "user_stats",
+            "localField": "members.user_id",
+            "foreignField": "user_id",
+            "as": "stats"
+        }},
+        {"$project": {
+            "name": 1,
+            "crew_streak": 1,
+            "members": {"$map": {
+                "input": {"$filter": {
+                    "input": "$members",
+                    "as": "member",
+                    "cond": {"$in": ["$$member.user_id", "$users.id"]}
+                }},
+                "as": "member",
+                "in": {
+                    "name": {"$arrayElemAt": ["$users.name", {"$indexOfArray": ["$users.id", "$$member.user_id"]}]},
+                    "current_streak": {"$ifNull": [
+                        {"$arrayElemAt": [
+                            "$stats.best_streak", {"$indexOfArray": ["$stats.user_id", "$$member.user_id"]}
+                        ]},
+                        0
+                    ]},
+                    "joined_at": "$$member.joined_at"
+                }
+            }}
+        }}
+    ]).to_list(1)
+    if not crews:
         raise HTTPException(status_code=404, detail="Not in a crew")
     
-    # Get crew details
-    crew = await db.crews.find_one({"id": membership["crew_id"]})
-    if not crew:
-        raise HTTPException(status_code=404, detail="Crew not found")
-    
-    # Get crew members
-    members = await db.crew_members.find({"crew_id": crew["id"]}).to_list(4)
-    member_data = []
-    
-    for member in members:
-        user = await db.users.find_one({"id": member["user_id"]})
-        if user:
-            # Get user's best current streak
-            user_habits = await db.habits.find({"user_id": user["id"]}).to_list(100)
-            best_streak = 0
-            for habit in user_habits:
-                stats = await db.habit_stats.find_one({"habit_id": habit["id"]})
-                if stats:
-                    best_streak = max(best_streak, stats["current_streak"])
-            
-            member_data.append({
-                "name": user["name"],
-                "current_streak": best_streak,
-                "joined_at": member["joined_at"]
-            })
-    
+    crew = crews[0]
     return {
         "crew_name": crew["name"],
         "crew_streak": crew["crew_streak"],
-        "members": member_data
+        "members": crew["members"]
     }
 
-@api_router.get("/crews/manage")
-async def get_crew_management(current_user: User = Depends(get_current_user)):
+@api_router.get("/crews/me", dependencies=[Depends(versioned_response("class"))])
+async def get_my_crew(current_user: User = Depends(get_current_user)):
+    return await load_my_crew(current_user)
+
+async def load_crew_management(current_user: User):
     """Get crew management data for teachers"""
     if current_user.role != "teacher":
         raise HTTPException(status_code=403, detail="Only teachers can manage crews")
     
-    # Get all crews in class
-    crews = await db.crews.find({"class_id": current_user.class_id}).to_list(100)
-    crew_data = []
-    
-    for crew in crews:
-        members = await db.crew_members.find({"crew_id": crew["id"]}).to_list(4)
-        member_details = []
-        
-        for member in members:
-            user = await db.users.find_one({"id": member["user_id"]})
-            if user:
-                member_details.append({
-                    "id": user["id"],
-                    "name": user["name"],
-                    "joined_at": member["joined_at"]
-                })
-        
-        crew_data.append({
-            "id": crew["id"],
-            "name": crew["name"],
-            "crew_streak": crew["crew_streak"],
-            "members": member_details,
-            "member_count": len(member_details)
-        })
-    
-    # Get unassigned students
-    all_students = await db.users.find({"class_id": current_user.class_id, "role": "student"}).to_list(1000)
-    assigned_student_ids = set()
-    
+    # Resolve every crew's members and the unassigned students in one aggregation,
+    # rooted at the class so crews and students come back in a single document
+    result = await db.classes.aggregate([
+        {"$match": {"id": current_user.class_id}},
+        {"$project": {"_id": 0, "id": 1}},
+        {"$lookup": {
+            "from": "crews",
+            "localField": "id",
+            "foreignField": "class_id",
+            "as": "crews"
+        }},
+        {"$lookup": {
+            "from": "users",
+            "localField": "id",
+            "foreignField": "class_id",
+            "as": "students"
+        }},
+        {"$project": {
+            "crews": {"$map": {
+                "input": "$crews",
+                "as": "crew",
+                "in": {
+                    "id": "$$crew.id",
+                    "name": "$$crew.name",
+                    "crew_streak": "$$crew.crew_streak",
+                    "members": {"$ifNull": ["$$crew.members", []]}
+                }
+            }},
+            "students": {"$map": {
+                "input": {"$filter": {"input": "$students", "as": "user", "cond": {"$eq": ["$$user.role", "student"]}}},
+                "as": "user",
+                "in": {"id": "$$user.id", "name": "$$user.name"}
+            }}
+        }},
+        {"$lookup": {
+            "from": "crew_members",
+            "localField": "students.id",
+            "foreignField": "user_id",
+            "as": "memberships"
+        }},
+        {"$project": {
+            "crews": {"$map": {
+                "input": "$crews",
+                "as": "crew",
+                "in": {
+                    "id": "$$crew.id",
+                    "name": "$$crew.name",
+                    "crew_streak": "$$crew.crew_streak",
+                    "members": {"$map": {
+                        "input": {"$filter": {
+                            "input": "$$crew.members",
+                            "as": "member",
+                            "cond": {"$in": ["$$member.user_id", "$students.id"]}
+                        }},
+                        "as": "member",
+                        "in": {
+                            "id": "$$member.user_id",
+                            "name": {"$arrayElemAt": [
+                                "$students.name", {"$indexOfArray": ["$students.id", "$$member.user_id"]}
+                            ]},
+                            "joined_at": "$$member.joined_at"
+                        }
+                    }}
+                }
+            }},
+            "unassigned_students": {"$filter": {
+                "input": "$students",
+                "as": "student",
+                "cond": {"$not": [{"$in": ["$$student.id", "$memberships.user_id"]}]}
+            }}
+        }}
+    ]).to_list(1)
+    
+    if not result:
+        return {"crews": [], "unassigned_students": []}
+    
+    crew_data = result[0]["crews"]
     for crew in crew_data:
-        for member in crew["members"]:
-            assigned_student_ids.add(member["id"])
-    
-    unassigned_students = []
-    for student in all_students:
-        if student["id"] not in assigned_student_ids:
-            unassigned_students.append({
-                "id": student["id"],
-                "name": student["name"]
-            })
+        crew["member_count"] = len(crew["members"])
     
     return {
         "crews": crew_data,
-        "unassigned_students": unassigned_students
+        "unassigned_students": result[0]["unassigned_students"]
     }
 
+@api_router.get("/crews/manage")
+async def get_crew_management(current_user: User = Depends(get_current_user)):
+    return await load_crew_management(current_user)
+
 @api_router.post("/crews/create")
 async def create_crew(crew_data: CrewCreate, current_user: User = Depends(get_current_user)):
     """Create a new crew"""
@@ -950,10 +1730,13 @@ async def create_crew(crew_data: CrewCreate, current_user: User = Depends(get_cu
         "class_id": current_user.class_id,
         "name": crew_data.name,
         "crew_streak": 0,
+        "members": [],
+        "member_count": 0,
         "created_at": datetime.utcnow()
     }
     
     await db.crews.insert_one(crew_doc)
+    await bump_data_versions(class_version_key(current_user.class_id))
     return {"message": "Crew created successfully", "crew_id": crew_doc["id"]}
 
 @api_router.post("/crews/assign")
@@ -967,29 +1750,36 @@ async def assign_student_to_crew(assignment: CrewAssignment, current_user: User
     if not student:
         raise HTTPException(status_code=404, detail="Student not found")
     
-    crew = await db.crews.find_one({"id": assignment.crew_id, "class_id": current_user.class_id})
-    if not crew:
-        raise HTTPException(status_code=404, detail="Crew not found")
-    
-    # Check if student is already in a crew
     existing_membership = await db.crew_members.find_one({"user_id": assignment.student_id})
-    if existing_membership:
-        # Remove from current crew
-        await db.crew_members.delete_one({"user_id": assignment.student_id})
+    if existing_membership and existing_membership["crew_id"] == assignment.crew_id:
+        return {"message": "Student assigned to crew successfully"}
     
-    # Check crew capacity
-    member_count = await db.crew_members.count_documents({"crew_id": assignment.crew_id})
-    if member_count >= 4:
-        raise HTTPException(status_code=400, detail="Crew is full (max 4 members)")
+    # Add to the new crew first, so a full crew leaves the student where they were
+    joined_at = datetime.utcnow()
+    crew = await add_crew_member(
+        {"id": assignment.crew_id, "class_id": current_user.class_id}, assignment.student_id, joined_at
+    )
+    if not crew:
+        if not await db.crews.find_one({"id": assignment.crew_id, "class_id": current_user.class_id}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="Crew not found")
+        raise HTTPException(status_code=400, detail=f"Crew is full (max {CREW_CAPACITY} members)")
     
-    # Add to new crew
-    crew_member = {
-        "id": str(uuid.uuid4()),
-        "crew_id": assignment.crew_id,
-        "user_id": assignment.student_id,
-        "joined_at": datetime.utcnow()
-    }
-    await db.crew_members.insert_one(crew_member)
+    await db.crew_members.update_one(
+        {"user_id": assignment.student_id},
+        {
+            "$set": {"crew_id": assignment.crew_id, "joined_at": joined_at},
+            "$setOnInsert": {"id": str(uuid.uuid4())}
+        },
+        upsert=True
+    )
+    
+    changed_crew_ids = [assignment.crew_id]
+    if existing_membership:
+        # Remove from previous crew
+        await remove_crew_member(existing_membership["crew_id"], assignment.student_id)
+        changed_crew_ids.append(existing_membership["crew_id"])
+    await refresh_crew_streaks(changed_crew_ids)
+    await bump_data_versions(class_version_key(current_user.class_id))
     
     return {"message": "Student assigned to crew successfully"}
 
@@ -1005,9 +1795,12 @@ async def remove_student_from_crew(student_id: str, current_user: User = Depends
         raise HTTPException(status_code=404, detail="Student not found")
     
     # Remove from crew
-    result = await db.crew_members.delete_one({"user_id": student_id})
-    if result.deleted_count == 0:
+    membership = await db.crew_members.find_one_and_delete({"user_id": student_id})
+    if not membership:
         raise HTTPException(status_code=404, detail="Student is not in any crew")
+    await remove_crew_member(membership["crew_id"], student_id)
+    await refresh_crew_streaks([membership["crew_id"]])
+    await bump_data_versions(class_version_key(current_user.class_id))
     
     return {"message": "Student removed from crew successfully"}
 
@@ -1029,26 +1822,40 @@ async def create_quest(quest_data: QuestCreate, current_user: User = Depends(get
     }
     
     await db.quests.insert_one(quest_doc)
+    await bump_data_versions(class_version_key(current_user.class_id), quests_version_key(current_user.class_id))
     
-    return Quest(**quest_doc)
+    quest = Quest(**quest_doc)
+    event_bus.publish(current_user.class_id, "quest_created", jsonable_encoder(quest))
+    return quest
 
-@api_router.get("/quests")
-async def get_quests(current_user: User = Depends(get_current_user)):
+async def load_quests(current_user: User, quests_version: Optional[int] = None):
     # Get active quests for user's class
     today = date.today()
-    quests = await db.quests.find({
-        "class_id": current_user.class_id,
-        "start_date": {"$lte": today.isoformat()},
-        "end_date": {"$gte": today.isoformat()}
-    }).to_list(100)
+    if quests_version is None:
+        quests_version = await get_data_version(quests_version_key(current_user.class_id))
+    cache_key = (current_user.class_id, today.isoformat(), quests_version)
+    quests = quest_cache.get(cache_key)
+    if quests is None:
+        quests = await db.quests.find({
+            "class_id": current_user.class_id,
+            "start_date": {"$lte": today.isoformat()},
+            "end_date": {"$gte": today.isoformat()}
+        }, {"_id": 0}).to_list(100)
+        quest_cache.set(cache_key, quests)
+    
+    if not quests:
+        return []
+    
+    # Check completion status for every quest in one query
+    completions = await db.quest_completions.find({
+        "quest_id": {"$in": [quest["id"] for quest in quests]},
+        "user_id": current_user.id
+    }, {"_id": 0}).to_list(len(quests))
+    completions_by_quest = {completion["quest_id"]: completion for completion in completions}
     
-    # Check completion status for each quest
     quest_list = []
     for quest in quests:
-        completion = await db.quest_completions.find_one({
-            "quest_id": quest["id"],
-            "user_id": current_user.id
-        })
+        completion = completions_by_quest.get(quest["id"])
         
         quest_data = Quest(**quest)
         quest_list.append({
@@ -1059,6 +1866,10 @@ async def get_quests(current_user: User = Depends(get_current_user)):
     
     return quest_list
 
+@api_router.get("/quests", dependencies=[Depends(versioned_response("user", "quests"))])
+async def get_quests(request: Request, current_user: User = Depends(get_current_user)):
+    return await load_quests(current_user, request.state.data_versions[quests_version_key(current_user.class_id)])
+
 @api_router.post("/quests/{quest_id}/complete")
 async def complete_quest(quest_id: str, current_user: User = Depends(get_current_user)):
     # Verify quest exists and is active
@@ -1101,12 +1912,13 @@ async def complete_quest(quest_id: str, current_user: User = Depends(get_current
         await db.quest_completions.insert_one(completion_doc)
     
     # Award XP
-    await award_xp(current_user.id, quest["xp_reward"], 1)
+    xp_result = await award_xp(current_user.id, quest["xp_reward"], 1, reason="quest_completion", source_id=quest_id)
+    await bump_data_versions(user_version_key(current_user.id))
+    publish_user_progress(current_user, xp_result, [])
     
     return {"message": "Quest completed!", "xp_awarded": quest["xp_reward"]}
 
-@api_router.get("/stats/me")
-async def get_my_stats(current_user: User = Depends(get_current_user)):
+async def load_my_stats(current_user: User):
     user_stats = await db.user_stats.find_one({"user_id": current_user.id})
     if not user_stats:
         # Create default stats if not found
@@ -1114,7 +1926,6 @@ async def get_my_stats(current_user: User = Depends(get_current_user)):
             "id": str(uuid.uuid4()),
             "user_id": current_user.id,
             "xp": 0,
-            "level": 1,
             "best_streak": 0,
             "total_completions": 0,
             "created_at": datetime.utcnow()
@@ -1122,7 +1933,7 @@ async def get_my_stats(current_user: User = Depends(get_current_user)):
         await db.user_stats.insert_one(user_stats)
     
     # Calculate XP for next level
-    current_level = user_stats["level"]
+    current_level = calculate_level_from_xp(user_stats["xp"])
     next_level_xp = get_xp_for_level(current_level + 1)
     current_level_xp = get_xp_for_level(current_level)
     progress_xp = max(0, user_stats["xp"] - current_level_xp)  # Clamp at 0
@@ -1130,7 +1941,7 @@ async def get_my_stats(current_user: User = Depends(get_current_user)):
     
     return {
         "xp": user_stats["xp"],
-        "level": user_stats["level"],
+        "level": current_level,
         "best_streak": user_stats["best_streak"],
         "total_completions": user_stats["total_completions"],
         "next_level_xp": next_level_xp,
@@ -1139,12 +1950,109 @@ async def get_my_stats(current_user: User = Depends(get_current_user)):
         "progress_percentage": (progress_xp / required_xp * 100) if required_xp > 0 else 100
     }
 
+@api_router.get("/stats/me", dependencies=[Depends(versioned_response("user"))])
+async def get_my_stats(current_user: User = Depends(get_current_user)):
+    return await load_my_stats(current_user)
+
+# Server-sent events: classmate activity, crew streaks, level-ups, crates and new quests
+async def get_event_stream_user(token: Optional[str] = None,
+                                credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    """Stream auth: an events token in the query string (EventSource), or the usual bearer header"""
+    if token:
+        return await get_user_from_token(token, scope=EVENT_STREAM_SCOPE)
+    if credentials:
+        return await get_user_from_token(credentials.credentials)
+    raise HTTPException(status_code=401, detail="Not authenticated")
+
+@api_router.post("/events/token")
+async def create_event_token(current_user: User = Depends(get_current_user)):
+    """Short-lived token for opening GET /api/events?token=... from a browser EventSource"""
+    return {"token": create_event_stream_token(current_user.id), "expires_in": EVENT_TOKEN_TTL_SECONDS}
+
+@api_router.get("/events")
+async def stream_events(request: Request, current_user: User = Depends(get_event_stream_user)):
+    async def event_stream():
+        # Subscribed only once the response starts streaming: a client that
+        # disconnects before then never runs the generator, so never needs closing
+        subscription = event_bus.subscribe(current_user.class_id, current_user.id)
+        try:
+            # Tells the client to refetch anything it may have missed before connecting
+            yield "retry: 5000\nevent: ready\ndata: {}\n\n"
+            while not await request.is_disconnected():
+                event = await subscription.next_event(EVENT_HEARTBEAT_SECONDS)
+                if event is None:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event.type}\ndata: {json.dumps(event.data)}\n\n"
+        finally:
+            subscription.close()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Composite dashboard: every panel the frontend loads on login, fetched concurrently
+DASHBOARD_SECTIONS = {
+    "habits": load_habits,
+    "feed": load_class_feed,
+    "class_info": load_class_info,
+    "stats": load_my_stats,
+    "crew": load_my_crew,
+    "quests": load_quests,
+    "analytics": lambda user: load_class_analytics(user.class_id, user),
+    "crew_management": load_crew_management,
+}
+TEACHER_DASHBOARD_SECTIONS = {"analytics", "crew_management"}
+
+@api_router.get("/dashboard", dependencies=[Depends(versioned_response("user", "class", "quests"))])
+async def get_dashboard(request: Request, sections: Optional[str] = None,
+                        current_user: User = Depends(get_current_user)):
+    """Load several dashboard sections in one request; `sections` is a comma-separated subset"""
+    if sections:
+        requested = [name.strip() for name in sections.split(",") if name.strip()]
+        unknown = [name for name in requested if name not in DASHBOARD_SECTIONS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown dashboard sections: {', '.join(unknown)}")
+    else:
+        requested = [
+            name for name in DASHBOARD_SECTIONS
+            if current_user.role == "teacher" or name not in TEACHER_DASHBOARD_SECTIONS
+        ]
+    
+    async def load_section(name: str):
+        try:
+            if name == "quests":
+                # Reuse the quests version the ETag check already read
+                quests_version = request.state.data_versions[quests_version_key(current_user.class_id)]
+                return await load_quests(current_user, quests_version), None
+            return await DASHBOARD_SECTIONS[name](current_user), None
+        except HTTPException as e:
+            # e.g. a student who isn't in a crew yet; the other sections still load
+            return None, e.detail
+    
+    results = await asyncio.gather(*[load_section(name) for name in requested])
+    
+    dashboard = {"errors": {}}
+    for name, (data, error) in zip(requested, results):
+        dashboard[name] = data
+        if error is not None:
+            dashboard["errors"][name] = error
+    return dashboard
+
 @api_router.get("/classes/{class_id}/export")
-async def export_class_csv(class_id: str, range_days: int = 30, current_user: User = Depends(get_current_user)):
+async def export_class_csv(class_id: str, request: Request, format: str = "csv",
+                           range_days: int = Query(30, ge=1, le=MAX_RANGE_DAYS),
+                           current_user: User = Depends(get_current_user)):
     # Verify user is teacher and owns this class
     if current_user.role != "teacher":
         raise HTTPException(status_code=403, detail="Only teachers can export class data")
     
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format '{format}'")
+    
     class_doc = await db.classes.find_one({"id": class_id, "teacher_id": current_user.id})
     if not class_doc:
         raise HTTPException(status_code=404, detail="Class not found or access denied")
@@ -1153,50 +2061,222 @@ async def export_class_csv(class_id: str, range_days: int = 30, current_user: Us
     end_date = date.today()
     start_date = end_date - timedelta(days=range_days)
     
-    # Get all students in class
-    students = await db.users.find({"class_id": class_id, "role": "student"}).to_list(1000)
+    export_format = EXPORT_FORMATS[format]
+    headers = {
+        "Content-Disposition": f"attachment; filename=class_{class_id}_{range_days}day_export.{export_format['extension']}"
+    }
+    if format == "csv":
+        # Streamed CSV is gzipped only for clients that accept it
+        headers["Vary"] = "Accept-Encoding"
+    
+    # Serve a finished export job's artifact when the class data hasn't changed since
+    data_version = await get_data_version(class_version_key(class_id))
+    artifact_path = export_artifact_path(class_id, range_days, start_date, end_date, format, data_version)
+    if artifact_path.exists():
+        return FileResponse(artifact_path, media_type=export_format["media_type"], headers=headers)
+    
+    rows = export_rows(db, class_id, start_date, end_date)
+    
+    if format != "csv":
+        # Columnar files need their footer written before they can be sent, so
+        # they are built batch by batch into a spooled file and streamed from there
+        spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_MEMORY)
+        try:
+            await write_arrow_export(rows, format, spool)
+        except Exception:
+            spool.close()
+            raise
+        return StreamingResponse(file_chunks(spool), media_type=export_format["media_type"], headers=headers)
+    
+    # Stream CSV chunks as rows arrive from a single joined cursor
+    chunks = csv_chunks(rows)
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    
+    return StreamingResponse(chunks, media_type=export_format["media_type"], headers=headers)
+
+# Background export jobs
+EXPORT_ARTIFACT_DIR = Path(os.getenv("EXPORT_ARTIFACT_DIR", str(ROOT_DIR / "export_artifacts")))
+export_job_slots = asyncio.Semaphore(int(os.getenv("EXPORT_WORKERS", "2")))
+export_job_tasks = set()
+
+def export_artifact_path(class_id: str, range_days: int, start_date: date, end_date: date,
+                         export_format: str, data_version: int) -> Path:
+    """Artifact location for an export of one class's data at one data version"""
+    extension = EXPORT_FORMATS[export_format]["extension"]
+    return EXPORT_ARTIFACT_DIR / (
+        f"class_{class_id}_{range_days}d_{start_date.isoformat()}_{end_date.isoformat()}_v{data_version}.{extension}"
+    )
+
+def export_artifact_generation(path: Path) -> Tuple[str, int]:
+    """(end date, data version) of an artifact; later exports of the same class and range sort higher"""
+    _, end_date, version = path.stem.rsplit("_", 2)
+    return end_date, int(version.lstrip("v"))
+
+async def run_export_job(job: dict, data_version: int):
+    """Write an export job's artifact, holding one of the EXPORT_WORKERS slots"""
+    # The task starts with a copy of the requesting context; detach it so the
+    # job's commands are recorded under the "background" route
+    current_request.set(None)
+    async with export_job_slots:
+        await db.export_jobs.update_one({"id": job["id"]}, {"$set": {"status": "running"}})
+        start_date = date.fromisoformat(job["start_date"])
+        end_date = date.fromisoformat(job["end_date"])
+        artifact_path = export_artifact_path(
+            job["class_id"], job["range_days"], start_date, end_date, job["format"], data_version
+        )
+        partial_path = artifact_path.with_name(f".{job['id']}.partial")
+        try:
+            EXPORT_ARTIFACT_DIR.mkdir(parents=True, exist_ok=True)
+            with open(partial_path, "wb") as sink:
+                await write_export_file(export_rows(db, job["class_id"], start_date, end_date), job["format"], sink)
+            
+            # Older data versions and dates for the same export are never served
+            # again. A job that finishes after a newer one keeps neither its file
+            # nor the right to remove the newer one.
+            generation = export_artifact_generation(artifact_path)
+            stale_pattern = f"class_{job['class_id']}_{job['range_days']}d_*{artifact_path.suffix}"
+            siblings = [path for path in EXPORT_ARTIFACT_DIR.glob(stale_pattern) if path != artifact_path]
+            if any(export_artifact_generation(path) > generation for path in siblings):
+                partial_path.unlink(missing_ok=True)
+            else:
+                os.replace(partial_path, artifact_path)
+                for stale_path in siblings:
+                    stale_path.unlink(missing_ok=True)
+            
+            await db.export_jobs.update_one(
+                {"id": job["id"]},
+                {"$set": {"status": "done", "artifact": artifact_path.name, "finished_at": datetime.utcnow()}}
+            )
+        except Exception as e:
+            partial_path.unlink(missing_ok=True)
+            logger.error(f"Export job {job['id']} failed: {str(e)}")
+            await db.export_jobs.update_one(
+                {"id": job["id"]},
+                {"$set": {"status": "failed", "error": str(e), "finished_at": datetime.utcnow()}}
+            )
+
+async def get_export_job_for_teacher(job_id: str, current_user: User) -> dict:
+    if current_user.role != "teacher":
+        raise HTTPException(status_code=403, detail="Only teachers can export class data")
+    
+    job = await db.export_jobs.find_one({"id": job_id, "requested_by": current_user.id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    return job
+
+@api_router.post("/classes/{class_id}/exports", status_code=202)
+async def create_export_job(class_id: str, job_data: ExportJobCreate, current_user: User = Depends(get_current_user)):
+    if current_user.role != "teacher":
+        raise HTTPException(status_code=403, detail="Only teachers can export class data")
     
-    # Create CSV data
-    csv_data = []
-    csv_data.append(["student_name", "habit_name", "date", "completed"])
+    if job_data.format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format '{job_data.format}'")
     
-    for student in students:
-        # Get student's habits
-        habits = await db.habits.find({"user_id": student["id"]}).to_list(1000)
-        
-        for habit in habits:
-            # Get logs in date range
-            logs = await db.habit_logs.find({
-                "habit_id": habit["id"],
-                "date": {
-                    "$gte": start_date.isoformat(),
-                    "$lte": end_date.isoformat()
-                }
-            }).to_list(1000)
-            
-            for log in logs:
-                csv_data.append([
-                    student["name"],
-                    habit["title"],
-                    log["date"],
-                    "Yes" if log["completed"] else "No"
-                ])
-    
-    # Create CSV string
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerows(csv_data)
-    csv_content = output.getvalue()
-    output.close()
-    
-    return Response(
-        content=csv_content,
-        media_type="text/csv",
-        headers={"Content-Disposition": f"attachment; filename=class_{class_id}_{range_days}day_export.csv"}
+    class_doc = await db.classes.find_one({"id": class_id, "teacher_id": current_user.id})
+    if not class_doc:
+        raise HTTPException(status_code=404, detail="Class not found or access denied")
+    
+    end_date = date.today()
+    start_date = end_date - timedelta(days=job_data.range_days)
+    data_version = await get_data_version(class_version_key(class_id))
+    job_key = {
+        "class_id": class_id,
+        "format": job_data.format,
+        "range_days": job_data.range_days,
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "data_version": data_version
+    }
+    
+    # Reuse a job already working on the same data
+    existing_job = await db.export_jobs.find_one(
+        {**job_key, "requested_by": current_user.id, "status": {"$in": ["queued", "running"]}}, {"_id": 0}
     )
+    if existing_job:
+        return ExportJob(**existing_job)
+    
+    job = {
+        "id": str(uuid.uuid4()),
+        **job_key,
+        "requested_by": current_user.id,
+        "status": "queued",
+        "created_at": datetime.utcnow()
+    }
+    
+    # Unchanged data is served from the artifact on disk without touching the class's data
+    artifact_path = export_artifact_path(class_id, job_data.range_days, start_date, end_date, job_data.format, data_version)
+    if artifact_path.exists():
+        job.update({"status": "done", "artifact": artifact_path.name, "finished_at": datetime.utcnow()})
+    
+    await db.export_jobs.insert_one(dict(job))
+    
+    if job["status"] == "queued":
+        task = asyncio.create_task(run_export_job(job, data_version))
+        export_job_tasks.add(task)
+        task.add_done_callback(export_job_tasks.discard)
+    
+    return ExportJob(**job)
 
-# Include the router in the main app
+@api_router.get("/exports/{job_id}")
+async def get_export_job(job_id: str, current_user: User = Depends(get_current_user)):
+    job = await get_export_job_for_teacher(job_id, current_user)
+    return ExportJob(**job)
+
+@api_router.get("/exports/{job_id}/download")
+async def download_export_job(job_id: str, current_user: User = Depends(get_current_user)):
+    job = await get_export_job_for_teacher(job_id, current_user)
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Export job is {job['status']}")
+    
+    artifact_path = EXPORT_ARTIFACT_DIR / job["artifact"]
+    if not artifact_path.exists():
+        raise HTTPException(status_code=410, detail="Export artifact has been replaced by newer data")
+    
+    export_format = EXPORT_FORMATS[job["format"]]
+    return FileResponse(
+        artifact_path,
+        media_type=export_format["media_type"],
+        filename=f"class_{job['class_id']}_{job['range_days']}day_export.{export_format['extension']}"
+    )
+
+@internal_router.get("/cache-stats")
+async def get_cache_stats():
+    return {"user_cache": user_cache.stats(), "quest_cache": quest_cache.stats(), "event_bus": event_bus.stats()}
+
+def cache_metric_lines() -> List[str]:
+    lines = [
+        "# HELP strive_cache_hits_total In-process cache hits.",
+        "# TYPE strive_cache_hits_total counter",
+        "# HELP strive_cache_misses_total In-process cache misses.",
+        "# TYPE strive_cache_misses_total counter",
+        "# HELP strive_cache_entries In-process cache entries.",
+        "# TYPE strive_cache_entries gauge",
+    ]
+    for name, cache in (("user", user_cache), ("quest", quest_cache)):
+        stats = cache.stats()
+        lines += [
+            f'strive_cache_hits_total{{cache="{name}"}} {stats["hits"]}',
+            f'strive_cache_misses_total{{cache="{name}"}} {stats["misses"]}',
+            f'strive_cache_entries{{cache="{name}"}} {stats["size"]}',
+        ]
+    lines += [
+        "# HELP strive_event_stream_subscribers Open /api/events streams.",
+        "# TYPE strive_event_stream_subscribers gauge",
+        f'strive_event_stream_subscribers {event_bus.stats()["subscribers"]}',
+    ]
+    return lines
+
+metrics_registry.add_collector(cache_metric_lines)
+
+@internal_router.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+# Include the routers in the main app
 app.include_router(api_router)
+app.include_router(internal_router)
 
 # CORS configuration
 cors_origin_env = os.getenv("CORS_ORIGIN")
@@ -1216,6 +2296,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Added last so it wraps everything, including CORS preflights
+app.add_middleware(MetricsMiddleware, registry=metrics_registry)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -1225,10 +2308,34 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("startup")
 async def startup_event():
+    if os.getenv("ENSURE_INDEXES_ON_STARTUP", "true").lower() == "true":
+        try:
+            results = await ensure_indexes(db)
+            failed = [row for row in results if row["status"].startswith("failed")]
+            logger.info(f"Verified {len(results) - len(failed)}/{len(results)} MongoDB indexes")
+        except Exception as e:
+            logger.error(f"Error ensuring MongoDB indexes: {str(e)}")
+    
+    # Export jobs that were in progress when the process stopped will never finish
+    await db.export_jobs.update_many(
+        {"status": {"$in": ["queued", "running"]}},
+        {"$set": {"status": "failed", "error": "Interrupted by a server restart", "finished_at": datetime.utcnow()}}
+    )
+    
+    try:
+        await backfill_crew_members()
+    except Exception as e:
+        logger.error(f"Error backfilling crew members: {str(e)}")
+    
+    # Must finish before any award, so a failure stops the process from serving
+    await record_opening_xp_balances()
+    
     scheduler.start()
     logger.info("Scheduler started for nightly cron jobs")
+    asyncio.create_task(resume_interrupted_nightly_run())
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
     scheduler.shutdown()
+    password_executor.shutdown(wait=False)
     client.close()
\ No newline at end of file
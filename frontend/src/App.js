@@ -634,53 +634,90 @@ const Dashboard = () => {
   const { user, logout } = useAuth();
 
   useEffect(() => {
-    fetchHabits();
-    fetchClassData();
-    fetchClassInfo();
-    fetchUserStats();
-    fetchCrewData();
-    fetchQuests();
-    if (user?.role === 'teacher') {
-      fetchAnalytics();
-      fetchCrewManagement();
-    }
+    fetchDashboard();
   }, [user]);
 
-  const fetchHabits = async () => {
-    try {
-      const response = await axios.get(`${API}/habits`);
-      setHabits(response.data);
-    } catch (error) {
-      console.error('Error fetching habits:', error);
-    }
-  };
+  // Live class updates. EventSource can't send the Authorization header, so each
+  // connection uses a short-lived stream token; reconnects fetch a fresh one.
+  useEffect(() => {
+    if (!user) return;
+
+    let source = null;
+    let retryTimer = null;
+    let closed = false;
+    let connectedBefore = false;
+
+    const connect = async () => {
+      try {
+        const response = await axios.post(`${API}/events/token`);
+        if (closed) return;
+        source = new EventSource(`${API}/events?token=${encodeURIComponent(response.data.token)}`);
+      } catch (error) {
+        console.error('Error opening live updates:', error);
+        retryTimer = setTimeout(connect, 5000);
+        return;
+      }
+
+      source.addEventListener('ready', () => {
+        // Anything published while disconnected was missed
+        if (connectedBefore) fetchDashboard();
+        connectedBefore = true;
+      });
+      source.addEventListener('resync', () => fetchDashboard());
+      source.addEventListener('feed_row', (event) => {
+        const row = JSON.parse(event.data);
+        setClassData(current => [...current.filter(member => member.user_id !== row.user_id), row]
+          .sort((a, b) => b.current_best_streak - a.current_best_streak));
+      });
+      source.addEventListener('crew_streak', (event) => {
+        const { crew_streak } = JSON.parse(event.data);
+        setCrewData(current => (current ? { ...current, crew_streak } : current));
+      });
+      source.addEventListener('quest_created', () => fetchQuests());
+      source.addEventListener('level_up', () => fetchUserStats());
+      source.onerror = () => {
+        // The stream token has expired by the time EventSource retries on its own
+        source.close();
+        if (!closed) retryTimer = setTimeout(connect, 5000);
+      };
+    };
+
+    connect();
+    return () => {
+      closed = true;
+      clearTimeout(retryTimer);
+      if (source) source.close();
+    };
+  }, [user]);
+
+  // Initial load: every panel in one request instead of one per panel
+  const fetchDashboard = async () => {
+    if (!user) return;
 
-  const fetchClassData = async () => {
     try {
-      const response = await axios.get(`${API}/my-class/feed`);
-      setClassData(response.data);
+      const response = await axios.get(`${API}/dashboard`);
+      const dashboard = response.data;
+      setHabits(dashboard.habits || []);
+      setClassData(dashboard.feed || []);
+      setClassInfo(dashboard.class_info);
+      setUserStats(dashboard.stats);
+      setCrewData(dashboard.crew);
+      setQuests(dashboard.quests || []);
+      if (user.role === 'teacher') {
+        setAnalytics(dashboard.analytics);
+        setCrewManagement(dashboard.crew_management || { crews: [], unassigned_students: [] });
+      }
     } catch (error) {
-      console.error('Error fetching class data:', error);
+      console.error('Error fetching dashboard:', error);
     }
   };
 
-  const fetchClassInfo = async () => {
+  const fetchHabits = async () => {
     try {
-      const response = await axios.get(`${API}/my-class/info`);
-      setClassInfo(response.data);
+      const response = await axios.get(`${API}/habits`);
+      setHabits(response.data);
     } catch (error) {
-      console.error('Error fetching class info:', error);
-    }
-  };
-
-  const fetchAnalytics = async () => {
-    if (user?.class_id) {
-      try {
-        const response = await axios.get(`${API}/classes/${user.class_id}/analytics`);
-        setAnalytics(response.data);
-      } catch (error) {
-        console.error('Error fetching analytics:', error);
-      }
+      console.error('Error fetching habits:', error);
     }
   };
 
@@ -728,20 +765,34 @@ const Dashboard = () => {
     setTimeout(() => setToast(null), 3000);
   };
 
+  // Apply a delta=true habit log response locally instead of refetching
+  const applyHabitDelta = (delta) => {
+    setHabits(current => current.map(habitData => (
+      habitData.habit.id === delta.habit_id
+        ? { ...habitData, today_completed: delta.today_completed, recent_logs: delta.recent_logs, stats: delta.stats }
+        : habitData
+    )));
+    setUserStats(delta.user_stats);
+    if (delta.feed_row) {
+      setClassData(current => current
+        .map(member => (member.user_id === delta.feed_row.user_id ? delta.feed_row : member))
+        .sort((a, b) => b.current_best_streak - a.current_best_streak));
+    }
+  };
+
   const toggleHabit = async (habitId, completed) => {
     try {
-      await axios.post(`${API}/habits/${habitId}/log`, {
+      const response = await axios.post(`${API}/habits/${habitId}/log?delta=true`, {
         date: new Date().toISOString().split('T')[0],
         completed: !completed
       });
-      fetchHabits();
-      fetchClassData();
-      fetchUserStats(); // Refresh XP after habit completion
+      applyHabitDelta(response.data);
       
       // Show success toast
       if (!completed) {
         showToast('Great job! +1 XP', 'success');
       }
+      response.data.rewards.forEach(reward => showToast(`Unlocked: ${reward.label}!`, 'success'));
     } catch (error) {
       console.error('Error logging habit:', error);
       showToast('Failed to log habit', 'error');
@@ -1236,7 +1287,7 @@ const Dashboard = () => {
               {classData.length > 0 ? (
                 <div className="space-y-3">
                   {classData.map((member, index) => (
-                    <div key={member.name} className="flex items-center justify-between p-4 bg-gray-700 rounded-lg">
+                    <div key={member.user_id} className="flex items-center justify-between p-4 bg-gray-700 rounded-lg">
                       <div className="flex items-center space-x-4">
                         <div className={`w-8 h-8 rounded-full flex items-center justify-center text-white font-bold ${
                           index === 0 ? 'bg-yellow-500' : 
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Login Load Benchmark
+Measures login throughput and the latency of an unrelated endpoint while a
+burst of logins is under way, e.g. a class of students signing in at the
+start of a lesson. Run it against a backend before and after changing
+BCRYPT_ROUNDS or PASSWORD_HASH_WORKERS to compare.
+
+    BACKEND_URL=http://localhost:8000/api python login_benchmark.py --students 30 --duration 20
+"""
+
+import argparse
+import os
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Backend base URL (env-driven)
+BACKEND_URL = os.environ.get("BACKEND_URL", "http://localhost:8000/api")
+PASSWORD = "BenchPass123!"
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def register(name, role, class_name):
+    response = requests.post(f"{BACKEND_URL}/auth/register", json={
+        "name": name,
+        "email": f"bench.{uuid.uuid4().hex[:10]}@test.com",
+        "password": PASSWORD,
+        "role": role,
+        "class_name": class_name
+    })
+    response.raise_for_status()
+    return response.json()["token"], response.json()["user"]["email"]
+
+
+def probe_latencies(token, stop, latencies):
+    """Repeatedly hit a cheap authenticated endpoint and record its latency"""
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {token}"
+    while not stop.is_set():
+        started = time.perf_counter()
+        session.get(f"{BACKEND_URL}/my-class/info")
+        latencies.append((time.perf_counter() - started) * 1000)
+        time.sleep(0.05)
+
+
+def login_worker(email, stop, login_latencies):
+    session = requests.Session()
+    while not stop.is_set():
+        started = time.perf_counter()
+        response = session.post(f"{BACKEND_URL}/auth/login", json={"email": email, "password": PASSWORD})
+        if response.status_code == 200:
+            login_latencies.append((time.perf_counter() - started) * 1000)
+
+
+def run_phase(token, emails, duration):
+    stop = threading.Event()
+    probe, logins = [], []
+    threads = [threading.Thread(target=probe_latencies, args=(token, stop, probe))]
+    threads += [threading.Thread(target=login_worker, args=(email, stop, logins)) for email in emails]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return probe, logins
+
+
+def report(label, probe, logins, duration):
+    print(f"\n=== {label} ===")
+    if logins:
+        print(f"   Logins: {len(logins)} in {duration}s ({len(logins) / duration:.1f}/s), "
+              f"p50 {statistics.median(logins):.0f} ms, p99 {percentile(logins, 99):.0f} ms")
+    print(f"   /my-class/info: {len(probe)} requests, "
+          f"p50 {statistics.median(probe) if probe else 0:.0f} ms, p99 {percentile(probe, 99):.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=30, help="concurrent students logging in")
+    parser.add_argument("--duration", type=int, default=15, help="seconds per phase")
+    args = parser.parse_args()
+
+    class_name = f"Bench Class {uuid.uuid4().hex[:6]}"
+    print(f"Registering teacher and {args.students} students in '{class_name}' at {BACKEND_URL}")
+    teacher_token, _ = register("Bench Teacher", "teacher", class_name)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        students = list(pool.map(
+            lambda i: register(f"Bench Student {i}", "student", class_name), range(args.students)
+        ))
+    emails = [email for _, email in students]
+
+    probe, _ = run_phase(teacher_token, [], args.duration)
+    report("Idle baseline", probe, [], args.duration)
+
+    probe, logins = run_phase(teacher_token, emails, args.duration)
+    report(f"{args.students} students logging in", probe, logins, args.duration)
+
+
+if __name__ == "__main__":
+    main()
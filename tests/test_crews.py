@@ -0,0 +1,102 @@
+import asyncio
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import mongomock_motor
+import pytest
+from fastapi import HTTPException
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "strive_test")
+
+import server  # noqa: E402
+from indexes import ensure_indexes  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = mongomock_motor.AsyncMongoMockClient()["strive_test"]
+    monkeypatch.setattr(server, "db", database)
+    asyncio.run(ensure_indexes(database))
+    return database
+
+
+def make_user(user_id, role="student"):
+    return server.User(
+        id=user_id, name=user_id, email=f"{user_id}@x.com", role=role, class_id="c1", created_at=datetime.utcnow()
+    )
+
+
+async def insert_students(db, count):
+    await db.users.insert_many([
+        {"id": f"s{i}", "name": f"s{i}", "email": f"s{i}@x.com", "class_id": "c1", "role": "student"}
+        for i in range(count)
+    ])
+
+
+async def create_crew(name):
+    response = await server.create_crew(server.CrewCreate(name=name), current_user=make_user("t1", "teacher"))
+    return response["crew_id"]
+
+
+async def join(crew_id, user_id):
+    return await server.join_crew(server.CrewJoinRequest(crew_id=crew_id), current_user=make_user(user_id))
+
+
+async def crew_counts(db):
+    """member_count and the embedded and claimed member counts of every crew, by crew id"""
+    counts = {}
+    async for crew in db.crews.find({}, {"_id": 0, "id": 1, "member_count": 1, "members": 1}):
+        claims = await db.crew_members.count_documents({"crew_id": crew["id"]})
+        counts[crew["id"]] = (crew["member_count"], len(crew["members"]), claims)
+    return counts
+
+
+def test_fifth_join_on_a_full_crew_is_rejected(db):
+    async def scenario():
+        await insert_students(db, 5)
+        crew_id = await create_crew("A")
+        for i in range(4):
+            await join(crew_id, f"s{i}")
+
+        with pytest.raises(HTTPException) as rejected:
+            await join(crew_id, "s4")
+        return rejected.value, await crew_counts(db), await db.crew_members.find_one({"user_id": "s4"})
+
+    rejected, counts, claim = asyncio.run(scenario())
+    assert (rejected.status_code, rejected.detail) == (400, "Crew is full")
+    assert list(counts.values()) == [(4, 4, 4)]
+    # The rejected join's membership claim is released
+    assert claim is None
+
+
+def test_member_count_follows_join_assign_and_remove(db):
+    async def scenario():
+        await insert_students(db, 3)
+        teacher = make_user("t1", "teacher")
+        crew_a = await create_crew("A")
+        crew_b = await create_crew("B")
+        snapshots = []
+
+        await join(crew_a, "s0")
+        await join(crew_a, "s1")
+        snapshots.append(await crew_counts(db))
+
+        # Moving a member updates both crews; assigning an unassigned student only the target
+        await server.assign_student_to_crew(server.CrewAssignment(student_id="s1", crew_id=crew_b), current_user=teacher)
+        await server.assign_student_to_crew(server.CrewAssignment(student_id="s2", crew_id=crew_b), current_user=teacher)
+        snapshots.append(await crew_counts(db))
+
+        await server.remove_student_from_crew("s0", current_user=teacher)
+        snapshots.append(await crew_counts(db))
+        return crew_a, crew_b, snapshots
+
+    crew_a, crew_b, snapshots = asyncio.run(scenario())
+    assert snapshots == [
+        {crew_a: (2, 2, 2), crew_b: (0, 0, 0)},
+        {crew_a: (1, 1, 1), crew_b: (2, 2, 2)},
+        {crew_a: (0, 0, 0), crew_b: (2, 2, 2)},
+    ]
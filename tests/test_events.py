@@ -0,0 +1,53 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from events import RESYNC, EventBus  # noqa: E402
+
+
+def test_events_reach_only_their_class_and_targeted_users():
+    async def scenario():
+        bus = EventBus()
+        alice = bus.subscribe("class-1", "alice")
+        bob = bus.subscribe("class-1", "bob")
+        other = bus.subscribe("class-2", "carol")
+
+        bus.publish("class-1", "quest_created", {"title": "Read"})
+        bus.publish("class-1", "level_up", {"level": 2}, user_ids=["alice"])
+
+        assert [e.type for e in [alice.queue.get_nowait(), alice.queue.get_nowait()]] == ["quest_created", "level_up"]
+        assert bob.queue.get_nowait().type == "quest_created"
+        assert bob.queue.empty()
+        assert other.queue.empty()
+
+    asyncio.run(scenario())
+
+
+def test_slow_subscriber_is_bounded_and_told_to_resync():
+    async def scenario():
+        bus = EventBus(max_queue=3)
+        slow = bus.subscribe("class-1", "alice")
+        for i in range(10):
+            bus.publish("class-1", "feed_row", {"i": i})
+
+        assert slow.queue.qsize() <= 3
+        assert RESYNC in [slow.queue.get_nowait().type for _ in range(slow.queue.qsize())]
+        assert bus.stats()["resyncs"] >= 1
+
+    asyncio.run(scenario())
+
+
+def test_closed_subscription_stops_receiving():
+    async def scenario():
+        bus = EventBus()
+        subscription = bus.subscribe("class-1", "alice")
+        subscription.close()
+        bus.publish("class-1", "quest_created")
+
+        assert subscription.queue.empty()
+        assert bus.stats()["subscribers"] == 0
+        assert await subscription.next_event(timeout=0.01) is None
+
+    asyncio.run(scenario())
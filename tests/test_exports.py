@@ -0,0 +1,20 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from exports import accepts_gzip  # noqa: E402
+
+
+def test_gzip_is_accepted_when_listed_or_covered_by_wildcard():
+    assert accepts_gzip("gzip, deflate, br")
+    assert accepts_gzip("br;q=1.0, gzip;q=0.5")
+    assert accepts_gzip("br, *;q=0.1")
+
+
+def test_gzip_refused_by_zero_quality_or_absence():
+    assert not accepts_gzip("gzip;q=0")
+    assert not accepts_gzip("br, gzip; q=0.000")
+    assert not accepts_gzip("gzip;q=0, *")
+    assert not accepts_gzip("identity")
+    assert not accepts_gzip("")
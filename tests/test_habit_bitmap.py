@@ -0,0 +1,77 @@
+import sys
+from datetime import date, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from habit_bitmap import HabitBitmap  # noqa: E402
+
+TODAY = date(2024, 3, 10)
+
+
+def day(offset):
+    return TODAY - timedelta(days=offset)
+
+
+def bitmap_with(completed_offsets, start_offset=30):
+    bitmap = HabitBitmap(day(start_offset))
+    for offset in completed_offsets:
+        bitmap.set(day(offset), True)
+    return bitmap
+
+
+def test_consecutive_completions_extend_streak():
+    bitmap = bitmap_with([2, 1, 0])
+
+    assert bitmap.current_streak(TODAY) == 3
+    assert bitmap.best_streak() == 3
+    assert bitmap.completed_count() == bitmap.total_count() == 3
+
+
+def test_gap_starts_new_run_and_keeps_best():
+    bitmap = bitmap_with([5, 4, 3, 0])
+
+    assert bitmap.current_streak(TODAY) == 1
+    assert bitmap.best_streak() == 3
+
+
+def test_streak_runs_back_to_start():
+    bitmap = bitmap_with(range(5), start_offset=4)
+
+    assert bitmap.current_streak(TODAY) == 5
+
+
+def test_uncompleted_log_counts_towards_total():
+    bitmap = bitmap_with([1, 0])
+    previous = bitmap.set(day(0), False)
+
+    assert previous is True
+    assert bitmap.get(day(0)) is False
+    assert bitmap.current_streak(TODAY) == 0
+    assert bitmap.completed_count() == 1
+    assert bitmap.total_count() == 2
+
+
+def test_backdated_completion_merges_runs():
+    bitmap = bitmap_with([3, 2, 0])
+    bitmap.set(day(1), True)
+
+    assert bitmap.current_streak(TODAY) == 4
+    assert bitmap.best_streak() == 4
+
+
+def test_log_before_start_moves_origin():
+    bitmap = bitmap_with([0], start_offset=0)
+    bitmap.set(day(1), True)
+
+    assert bitmap.start == day(1)
+    assert bitmap.current_streak(TODAY) == 2
+
+
+def test_round_trip_and_recent_strip():
+    bitmap = bitmap_with([8, 6, 1, 0])
+    bitmap.set(day(3), False)
+    restored = HabitBitmap.from_fields(bitmap.to_fields())
+
+    assert restored.recent(TODAY) == [(day(6), True), (day(3), False), (day(1), True), (day(0), True)]
+    assert restored.best_streak() == 2
@@ -0,0 +1,58 @@
+import asyncio
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import mongomock_motor
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from indexes import PIPELINE_SHAPES, ensure_indexes, unindexed_lookups  # noqa: E402
+
+
+def status_of(results, collection, index):
+    return next(row["status"] for row in results if row["collection"] == collection and row["index"] == index)
+
+
+def test_duplicate_logs_are_removed_keeping_the_latest():
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["strive_test"]
+        await db.habit_logs.insert_many([
+            {"habit_id": "h1", "date": "2024-01-01", "completed": True, "created_at": datetime(2024, 1, 1, 8)},
+            {"habit_id": "h1", "date": "2024-01-01", "completed": False, "created_at": datetime(2024, 1, 1, 9)},
+            {"habit_id": "h1", "date": "2024-01-02", "completed": True, "created_at": datetime(2024, 1, 2, 8)},
+        ])
+        results = await ensure_indexes(db)
+        logs = await db.habit_logs.find({}, {"_id": 0, "date": 1, "completed": 1}).sort("date", 1).to_list(None)
+        return status_of(results, "habit_logs", "habit_id_1_date_1"), logs
+
+    status, logs = asyncio.run(scenario())
+    assert status == "ok (removed 1 duplicates)"
+    assert logs == [{"date": "2024-01-01", "completed": False}, {"date": "2024-01-02", "completed": True}]
+
+
+def test_duplicate_users_are_reported_not_removed():
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["strive_test"]
+        await db.users.insert_many([{"id": "u1", "email": "a@x.com"}, {"id": "u2", "email": "a@x.com"}])
+        results = await ensure_indexes(db)
+        return status_of(results, "users", "email_1"), await db.users.count_documents({})
+
+    status, users = asyncio.run(scenario())
+    assert status.startswith("failed")
+    assert users == 2
+
+
+def test_every_route_lookup_joins_on_an_indexed_field():
+    assert {shape.name: unindexed_lookups(shape.pipeline) for shape in PIPELINE_SHAPES} == {
+        shape.name: [] for shape in PIPELINE_SHAPES
+    }
+
+
+def test_lookup_without_a_leading_index_is_flagged():
+    pipeline = [
+        {"$match": {"class_id": ""}},
+        {"$lookup": {"from": "habit_logs", "localField": "id", "foreignField": "date", "as": "logs"}},
+        {"$lookup": {"from": "habits", "localField": "id", "foreignField": "user_id", "as": "habits"}},
+    ]
+    assert unindexed_lookups(pipeline) == ["habit_logs.date"]
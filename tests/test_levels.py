@@ -0,0 +1,31 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from levels import calculate_level_from_xp  # noqa: E402
+
+
+def level_by_scan(xp):
+    level = 1
+    while xp >= 10 * (level ** 1.5):
+        level += 1
+    return level - 1 if level > 1 else 1
+
+
+def test_matches_level_by_level_scan():
+    for xp in list(range(0, 5000)) + [28, 29, 51, 52, 99_999, 250_000]:
+        assert calculate_level_from_xp(xp) == level_by_scan(xp)
+
+
+def test_threshold_boundaries():
+    assert calculate_level_from_xp(0) == 1
+    assert calculate_level_from_xp(28) == 1
+    assert calculate_level_from_xp(29) == 2
+    assert calculate_level_from_xp(52) == 3
+
+
+def test_levels_continue_past_the_table():
+    for xp in [316_227, 316_228, 316_229, 10_000_000, 10**9]:
+        assert calculate_level_from_xp(xp) == level_by_scan(xp)
+    assert calculate_level_from_xp(10**9) > 1000
@@ -0,0 +1,55 @@
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from metrics import MetricsMiddleware, MetricsRegistry, MongoCommandMetrics  # noqa: E402
+
+
+def fake_command(listener, request_id, name, collection, micros=2000):
+    started = SimpleNamespace(request_id=request_id, connection_id=("db", 27017),
+                              command_name=name, command={name: collection})
+    listener.started(started)
+    listener.succeeded(SimpleNamespace(request_id=request_id, connection_id=("db", 27017),
+                                       command_name=name, duration_micros=micros))
+
+
+def build_app():
+    registry = MetricsRegistry()
+    listener = MongoCommandMetrics(registry)
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def get_item(item_id: str):
+        for i in range(3):
+            fake_command(listener, i, "find", "items")
+        return {"id": item_id}
+
+    app.add_middleware(MetricsMiddleware, registry=registry)
+    return app, registry, listener
+
+
+def test_commands_are_attributed_to_the_route_template():
+    app, registry, _ = build_app()
+    client = TestClient(app)
+    client.get("/items/a")
+    client.get("/items/b")
+
+    text = registry.render()
+    assert 'strive_http_requests_total{method="GET",route="/items/{item_id}",status="200"} 2' in text
+    assert ('strive_mongo_command_duration_seconds_count'
+            '{route="/items/{item_id}",command="find",collection="items"} 6') in text
+    assert 'strive_mongo_commands_per_request_bucket{method="GET",route="/items/{item_id}",le="5"} 2' in text
+    assert 'strive_http_request_duration_seconds_count{method="GET",route="/items/{item_id}"} 2' in text
+
+
+def test_commands_outside_requests_are_background():
+    _, registry, listener = build_app()
+    fake_command(listener, 1, "aggregate", "users")
+
+    assert ('strive_mongo_command_duration_seconds_count'
+            '{route="background",command="aggregate",collection="users"} 1') in registry.render()
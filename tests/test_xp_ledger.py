@@ -0,0 +1,77 @@
+import asyncio
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import mongomock_motor
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "strive_test")
+
+import server  # noqa: E402
+from indexes import ensure_indexes  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = mongomock_motor.AsyncMongoMockClient()["strive_test"]
+    monkeypatch.setattr(server, "db", database)
+    asyncio.run(ensure_indexes(database))
+    return database
+
+
+async def stored_totals(db, user_id):
+    return await db.user_stats.find_one({"user_id": user_id}, {"_id": 0, "xp": 1, "total_completions": 1})
+
+
+def test_replay_keeps_xp_earned_before_the_ledger(db):
+    async def scenario():
+        await db.user_stats.insert_one({"user_id": "u1", "xp": 500, "total_completions": 40})
+        await server.record_opening_xp_balances()
+        await server.award_xp("u1", 1)
+
+        await server.replay_xp_ledger()
+        return await stored_totals(db, "u1")
+
+    assert asyncio.run(scenario()) == {"xp": 501, "total_completions": 41}
+
+
+def test_opening_balance_excludes_awards_already_in_the_ledger(db):
+    async def scenario():
+        await db.user_stats.insert_one({"user_id": "u1", "xp": 500, "total_completions": 40})
+        # Awarded after the ledger shipped but before the migration ran
+        await server.award_xp("u1", 3)
+
+        await server.replay_xp_ledger()
+        return await stored_totals(db, "u1")
+
+    assert asyncio.run(scenario()) == {"xp": 503, "total_completions": 41}
+
+
+def test_opening_balances_are_recorded_once(db):
+    async def scenario():
+        await db.user_stats.insert_one({"user_id": "u1", "xp": 500, "total_completions": 40})
+        await server.record_opening_xp_balances()
+        await db.migrations.delete_many({})
+        await server.record_opening_xp_balances()
+
+        await server.replay_xp_ledger()
+        return await stored_totals(db, "u1"), await db.xp_events.count_documents({"reason": "opening_balance"})
+
+    assert asyncio.run(scenario()) == ({"xp": 500, "total_completions": 40}, 1)
+
+
+def test_migration_claim_waits_for_the_process_running_it(db):
+    async def scenario():
+        assert await server.claim_migration("m") is True
+        waiting = asyncio.create_task(server.claim_migration("m"))
+        await asyncio.sleep(0.2)
+        assert not waiting.done()
+
+        await db.migrations.update_one({"name": "m"}, {"$set": {"completed_at": datetime.utcnow()}})
+        return await waiting
+
+    assert asyncio.run(scenario()) is False